@@ -0,0 +1,295 @@
+import argparse
+import json
+import multiprocessing as mp
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Callable, Iterator
+
+from core import (
+    Key,
+    KeyCache,
+    auto_chunk_size,
+    decrypt_files,
+    encrypt_files,
+    zip_folder,
+)
+from helpers import File, path_size
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Benchmark of the core crypto pipeline on synthetic corpora.
+# Usage: python benchmark.py [--scale 0.25] [--baseline benchmark_baseline.json]
+
+PASSWORD = "benchmark"
+DEFAULT_BASELINE = Path(__file__).with_name("benchmark_baseline.json")
+DEFAULT_TOLERANCE = 0.15  # Allowed slowdown and memory growth compared to the baseline
+MIB = 1024**2
+
+
+def peak_rss() -> int | None:
+    """Peak resident set size of this process in bytes, None if unknown."""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == "darwin" else usage * 1024  # KiB on Linux
+
+
+def write_random(path: Path, size: int) -> None:
+    with open(path, "wb") as file:
+        while size > 0:
+            file.write(os.urandom(min(size, 16 * MIB)))
+            size -= 16 * MIB
+
+
+def make_huge(root: Path, scale: float) -> list[Path]:
+    """One large file."""
+    path = root / "huge.bin"
+    write_random(path, int(512 * MIB * scale))
+    return [path]
+
+
+def make_tiny(root: Path, scale: float) -> list[Path]:
+    """Many small files."""
+    folder = root / "tiny"
+    folder.mkdir()
+    paths = []
+    for index in range(max(1, int(2000 * scale))):
+        paths.append(path := folder / f"{index}.txt")
+        write_random(path, 512 + index % 4096)
+    return paths
+
+
+def make_tree(root: Path, scale: float) -> list[Path]:
+    """Deep folder tree, encrypted as a single folder."""
+    folder = root / "tree"
+    for branch in range(max(1, int(8 * scale))):
+        path = folder / f"branch{branch}"
+        for depth in range(16):
+            path = path / f"level{depth}"
+            path.mkdir(parents=True)
+            for index in range(4):
+                write_random(path / f"{index}.bin", 64 * 1024)
+    return [folder]
+
+
+CORPORA: dict[str, Callable[[Path, float], list[Path]]] = {
+    "huge": make_huge,
+    "tiny": make_tiny,
+    "tree": make_tree,
+}
+
+
+def consume(results: Iterator) -> None:
+    """Run a processor to completion, failing on any error it reports."""
+    for result in results:
+        if type(result[0]) not in (int, float, complex):
+            raise RuntimeError(f"{result[1]}: {result[0]!r}")
+
+
+def consume_zip(folder: Path) -> None:
+    with open(os.devnull, "wb") as sink:
+        for _ in zip_folder(folder, sink):
+            pass
+
+
+def add_phases(breakdown: Counter, event: dict) -> None:
+    """Sum per-phase seconds of file_end events."""
+    if event["event"] == "file_end":
+        breakdown.update(event["phases"])
+
+
+def rounded(breakdown: Counter) -> dict[str, float]:
+    return {phase: round(seconds, 4) for phase, seconds in breakdown.items()}
+
+
+def derive_key() -> None:
+    Key.key_derive(PASSWORD)
+
+
+def encrypt_corpus(
+    inputs: dict[File, Path], derived_key: tuple[bytes, bytes], threads: int | None
+) -> dict:
+    breakdown: Counter[str] = Counter()
+    on_event = partial(add_phases, breakdown)
+    consume(encrypt_files(inputs, PASSWORD, derived_key, threads, on_event=on_event))
+    return {"breakdown": rounded(breakdown)}
+
+
+def decrypt_corpus(
+    inputs: dict[File, Path], derived_key: tuple[bytes, bytes], threads: int | None
+) -> dict:
+    breakdown: Counter[str] = Counter()
+    on_event = partial(add_phases, breakdown)
+    with KeyCache() as key_cache:
+        key_cache.put(PASSWORD, derived_key[1], derived_key[0])
+        consume(decrypt_files(inputs, PASSWORD, key_cache, threads, on_event=on_event))
+        return {"breakdown": rounded(breakdown), "key_cache": key_cache.stats()}
+
+
+def timed(func: Callable[..., dict | None], *args) -> tuple[float, int | None, dict]:
+    """Run func in this process. Returns seconds, peak RSS and what func returned."""
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, peak_rss(), result or {}
+
+
+def measure(func: Callable[..., dict | None], size: int, *args) -> dict:
+    """Time func(*args) in a new process, so peak RSS is that of this phase alone
+    (plus the interpreter) rather than the highest one of the whole run.
+    func and args must be picklable. Whatever func returns is added to the result.
+    Processes are forked by a small server process where possible, as forked and
+    even spawned processes start with the peak RSS of their parent on Linux."""
+    methods = mp.get_all_start_methods()
+    context = mp.get_context("forkserver" if "forkserver" in methods else "spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        seconds, rss, extra = executor.submit(timed, func, *args).result()
+    return {
+        "seconds": round(seconds, 4),
+        "bytes": size,
+        "mb_s": round(size / MIB / seconds, 2) if size else None,
+        "peak_rss": rss,
+        **extra,
+    }
+
+
+def bench_corpus(root: Path, name: str, scale: float, threads: int | None) -> dict:
+    """Time encryption, decryption and (for folders) zipping of a corpus.
+    The password key is derived beforehand, so only data processing is measured."""
+    paths = CORPORA[name](root, scale)
+    inputs = {File(path, path_size(path)): Path(f"{path}.teax") for path in paths}
+    size = sum(file.size for file in inputs)
+    derived_key = Key.key_derive(PASSWORD)
+    phases: dict = {"files": len(inputs)}
+
+    if len(paths) == 1 and paths[0].is_file():
+        phases["chunk_size"] = auto_chunk_size(paths[0], size)
+    if paths[0].is_dir():
+        phases["zip_folder"] = measure(consume_zip, size, paths[0])
+
+    phases["encrypt"] = measure(encrypt_corpus, size, inputs, derived_key, threads)
+    outputs = {
+        File(path, path_size(path)): path.with_name(f"{path.name}.out")
+        for path in inputs.values()
+    }
+    phases["decrypt"] = measure(decrypt_corpus, size, outputs, derived_key, threads)
+    return phases
+
+
+def run(scale: float, corpora: list[str], threads: int | None) -> dict:
+    results: dict = {"scale": scale, "cpu_count": os.cpu_count()}
+    results["key_derive"] = measure(derive_key, 0)
+    for name in corpora:
+        with tempfile.TemporaryDirectory(prefix="vaultea-bench-") as root:
+            results[name] = bench_corpus(Path(root), name, scale, threads)
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Return regressions: phases that got slower or need more memory (peak RSS)
+    than baseline allows."""
+    regressions = []
+    for corpus, phases in baseline.items():
+        if not isinstance(phases, dict) or corpus not in results:
+            continue
+        if "seconds" in phases:  # Single phase, e.g. key_derive
+            phases, current_phases = {"": phases}, {"": results[corpus]}
+        else:
+            current_phases = results[corpus]
+        for phase, old in phases.items():
+            if not isinstance(old, dict) or phase not in current_phases:
+                continue
+            new = current_phases[phase]
+            if new["seconds"] > old["seconds"] * (1 + tolerance):
+                name = f"{corpus} {phase}".strip()
+                regressions.append(f"{name}: {old['seconds']}s -> {new['seconds']}s")
+            if old.get("peak_rss") and new.get("peak_rss"):
+                if new["peak_rss"] > old["peak_rss"] * (1 + tolerance):
+                    name = f"{corpus} {phase}".strip()
+                    old_mib, new_mib = old["peak_rss"] / MIB, new["peak_rss"] / MIB
+                    regressions.append(
+                        f"{name}: peak RSS {old_mib:.1f} MiB -> {new_mib:.1f} MiB"
+                    )
+    return regressions
+
+
+def describe_rss(result: dict) -> str:
+    return f", {rss / MIB:.1f} MiB peak RSS" if (rss := result["peak_rss"]) else ""
+
+
+def print_results(results: dict) -> None:
+    key_derive = results["key_derive"]
+    print(f"key_derive: {key_derive['seconds']}s{describe_rss(key_derive)}")
+    for corpus, phases in results.items():
+        if not isinstance(phases, dict) or "seconds" in phases:
+            continue
+        size = phases.get("encrypt", {}).get("bytes", 0)
+        print(f"{corpus}: {phases['files']} files, {size / MIB:.1f} MiB")
+        if "chunk_size" in phases:
+            print(f"  auto chunk size: {phases['chunk_size'] // 1024} KiB")
+        for phase, result in phases.items():
+            if isinstance(result, dict):
+                print(
+                    f"  {phase}: {result['seconds']}s, {result['mb_s']} MB/s"
+                    f"{describe_rss(result)}"
+                )
+                for name, seconds in result.get("breakdown", {}).items():
+                    print(f"    {name}: {seconds}s")
+                if cache := result.get("key_cache"):
+                    hits, misses = cache["hits"], cache["misses"]
+                    print(f"    key cache: {hits} hits, {misses} misses")
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark Vaultea core pipeline.")
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="corpus size multiplier"
+    )
+    parser.add_argument(
+        "--corpus", choices=CORPORA, action="append", help="run only given corpora"
+    )
+    parser.add_argument("--threads", type=int, help="threads for large files")
+    parser.add_argument(
+        "--baseline", type=Path, default=DEFAULT_BASELINE, help="baseline JSON"
+    )
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="store results as the baseline"
+    )
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--json", type=Path, help="also write results to this file")
+    args = parser.parse_args(argv)
+
+    results = run(args.scale, args.corpus or list(CORPORA), args.threads)
+    print_results(results)
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2))
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(results, indent=2))
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+    if not args.baseline.exists():
+        return 0
+
+    baseline = json.loads(args.baseline.read_text())
+    if baseline.get("scale") != args.scale:
+        print(f"Baseline was recorded with scale {baseline.get('scale')}, not compared")
+        return 0
+    if regressions := compare(results, baseline, args.tolerance):
+        print("Regressions:")
+        print("\n".join(f"  {regression}" for regression in regressions))
+        return 1
+    print("No regressions compared to baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,488 @@
+import argparse
+import getpass
+import glob
+import json
+import multiprocessing as mp
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Iterator, TextIO
+
+from compress import available_algorithms
+from core import KeyCache, extract_members, inspect_file, open_archive
+from helpers import File, derive_path, path_size
+from parallel import DEFAULT_MEMORY_BUDGET, process_files_parallel
+from progress import Progress
+from repository import Repository, backup, prune, restore
+from timing import EventCallback
+
+# Headless command line interface. Doesn't import any GUI modules.
+# Progress and results are printed as JSON lines to stdout.
+
+PROGRESS_INTERVAL = 0.5  # Seconds between progress lines
+SIZE_SUFFIXES = {"K": 1024, "M": 1024**2, "G": 1024**3}
+
+
+def emit(event: str, **fields) -> None:
+    print(json.dumps({"event": event, **fields}), flush=True)
+
+
+def parse_size(value: str) -> int | None:
+    """Parse size like 4M or 512K. 'auto' means None."""
+    if value.lower() == "auto":
+        return None
+    multiplier = SIZE_SUFFIXES.get(value[-1:].upper(), 1)
+    number = value[:-1] if multiplier > 1 else value
+    try:
+        return int(float(number) * multiplier)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {value}")
+
+
+def event_printer(args: argparse.Namespace) -> EventCallback | None:
+    """Print instrumentation events (per-file phase timings) if asked to."""
+    return (lambda event: emit(**event)) if args.events else None
+
+
+def read_password(args: argparse.Namespace) -> str:
+    """Take the password from an environment variable, a file descriptor, stdin
+    (only with --password-stdin) or an interactive prompt. Empty passwords and
+    input that ends before a line is read are refused."""
+    if args.password_env:
+        if (password := os.environ.get(args.password_env)) is None:
+            raise SystemExit(f"Environment variable {args.password_env} is not set.")
+        return check_password(password)
+    if args.password_fd is not None:
+        with os.fdopen(args.password_fd, "r", closefd=False) as file:
+            return check_password(read_line(file))
+    if args.password_stdin:
+        return check_password(read_line(sys.stdin))
+    if not sys.stdin.isatty():
+        raise SystemExit(
+            "No terminal to ask for the password, use --password-stdin,"
+            " --password-fd or --password-env."
+        )
+    password = check_password(getpass.getpass())
+    if args.command in ("encrypt", "backup") and password != getpass.getpass(
+        "Confirm password: "
+    ):
+        raise SystemExit("Passwords do not match.")
+    return password
+
+
+def read_line(file: TextIO) -> str:
+    if not (line := file.readline()):
+        raise SystemExit("No password given, input ended.")
+    return line.rstrip("\r\n")
+
+
+def check_password(password: str) -> str:
+    if not password:
+        raise SystemExit("Password must not be empty.")
+    return password
+
+
+def expand_inputs(patterns: list[str], recursive: bool, mode: str) -> dict[Path, Path]:
+    """Expand glob patterns. Folders are encrypted as a whole unless recursive is set,
+    then every file inside them is processed on its own.
+    Returns input paths mapped to their path relative to the output folder."""
+    paths: dict[Path, Path] = {}
+    for pattern in patterns:
+        matches = glob.glob(pattern, recursive=True) or [pattern]
+        for match in sorted(matches):
+            path = Path(match)
+            if path.is_dir() and (recursive or mode != "_enc"):
+                if not recursive:
+                    emit("skipped", file=str(path), reason="is a folder")
+                    continue
+                for file in sorted(p for p in path.rglob("*") if p.is_file()):
+                    paths[file] = file.relative_to(path.parent)
+            else:
+                paths[path] = Path(path.name)
+    return paths
+
+
+def build_files(
+    paths: dict[Path, Path], mode: str, output_dir: Path | None, force: bool
+) -> dict[File, Path]:
+    files: dict[File, Path] = {}
+    outputs: set[Path] = set()
+    for path, relative in paths.items():
+        try:
+            file_in = File(path, path_size(path))
+        except FileNotFoundError:
+            emit("result", file=str(path), status="error", error="not found")
+            continue
+        file_out = derive_path(path, mode, None)
+        if output_dir:
+            # Mirror folder structure of recursive inputs
+            file_out = output_dir / relative.parent / file_out.name
+            file_out.parent.mkdir(parents=True, exist_ok=True)
+        if file_out in outputs or (file_out.exists() and not force):
+            emit("result", file=str(path), status="error", error=f"{file_out} exists")
+            continue
+        outputs.add(file_out)
+        files[file_in] = file_out
+    return files
+
+
+def event_collector(
+    args: argparse.Namespace, outcomes: dict[str, dict]
+) -> EventCallback:
+    """Keep file_end events by full path in outcomes, and print events if asked to."""
+    printer = event_printer(args)
+
+    def on_event(event: dict) -> None:
+        if event["event"] == "file_end":
+            outcomes[event["file"]] = event
+        if printer:
+            printer(event)
+
+    return on_event
+
+
+def report(
+    files: list[File],
+    results: Iterator,
+    progress: Progress,
+    outcomes: dict[str, dict],
+    verify: bool = False,
+) -> int:
+    """Print throttled progress (see progress.Progress.report) and per-file results,
+    taken from file_end events collected in outcomes (see event_collector).
+    Returns number of failures. Verification reports the status of failed files,
+    other operations report them as failed with an error."""
+    # Errors of worker processes that died before reporting any file_end event.
+    # These only come with the file name.
+    crashes: dict[str, str] = {}
+    for result in results:
+        if type(result[0]) in (int, float, complex):
+            if update := progress.poll():
+                emit("progress", **update)
+        elif result[0] is not False:
+            crashes[result[1]] = repr(result[0])
+
+    failures = 0
+    for file in files:
+        path = str(file.path)
+        outcome = outcomes.get(path)
+        if outcome is None:
+            error = crashes.get(file.path.name, "not processed")
+            emit("result", file=path, status="failed", error=error)
+        elif outcome["status"] == "ok":
+            emit("result", file=path, status="ok")
+            continue
+        elif verify:
+            error = {"error": outcome["error"]} if "error" in outcome else {}
+            emit("result", file=path, status=outcome["status"], **error)
+        else:
+            error = outcome.get("error", "incorrect password or corrupt data")
+            emit("result", file=path, status="failed", error=error)
+        failures += 1
+    return failures
+
+
+def process_command(args: argparse.Namespace) -> int:
+    mode = "_enc" if args.command == "encrypt" else "_dec"
+    paths = expand_inputs(args.inputs, args.recursive, mode)
+    files = build_files(paths, mode, args.output, args.force)
+    if not files:
+        return 1
+    password = read_password(args)
+    outcomes: dict[str, dict] = {}
+    progress = Progress([file.size for file in files], PROGRESS_INTERVAL)
+    with KeyCache() as key_cache:
+        results = process_files_parallel(
+            files,
+            password,
+            mode,
+            workers=args.workers,
+            memory_budget=args.memory_budget,
+            batch_key=not args.per_file_keys,
+            key_cache=key_cache,
+            chunk_size=args.chunk_size,
+            on_event=event_collector(args, outcomes),
+            compression=args.compress,
+            compression_level=args.level,
+            progress=progress,
+        )
+        failures = report(list(files), results, progress, outcomes)
+        failures += len(paths) - len(files)
+        if mode == "_dec":
+            emit("key_cache", **key_cache.stats())
+    return int(failures > 0)
+
+
+def verify_command(args: argparse.Namespace) -> int:
+    paths = expand_inputs(args.inputs, args.recursive, "_dec")
+    files: dict[File, Path] = {}
+    for path in paths:
+        if not path.is_file():
+            emit("result", file=str(path), status="error", error="not found")
+            continue
+        files[File(path, path.stat().st_size)] = Path(os.devnull)
+    if not files:
+        return 1
+    password = read_password(args)
+    outcomes: dict[str, dict] = {}
+    progress = Progress([file.size for file in files], PROGRESS_INTERVAL)
+
+    with KeyCache() as key_cache:
+        results = process_files_parallel(
+            files,
+            password,
+            "_ver",
+            workers=args.workers,
+            memory_budget=args.memory_budget,
+            key_cache=key_cache,
+            chunk_size=args.chunk_size,
+            on_event=event_collector(args, outcomes),
+            progress=progress,
+        )
+        failures = report(list(files), results, progress, outcomes, verify=True)
+        emit("key_cache", **key_cache.stats())
+    failures += len(paths) - len(files)
+    return int(failures > 0)
+
+
+def inspect_command(args: argparse.Namespace) -> int:
+    status = 0
+    for path in expand_inputs(args.inputs, args.recursive, "_dec"):
+        try:
+            emit("inspect", file=str(path), **inspect_file(path))
+        except (OSError, ValueError) as err:
+            emit("inspect", file=str(path), error=str(err))
+            status = 1
+    return status
+
+
+def list_command(args: argparse.Namespace) -> int:
+    with open_archive(args.archive, read_password(args)) as archive:
+        for member in archive.infolist():
+            emit("member", name=member.filename, size=member.file_size)
+    return 0
+
+
+def extract_command(args: argparse.Namespace) -> int:
+    password = read_password(args)
+    for path in extract_members(args.archive, password, args.members, args.output):
+        emit("extracted", file=str(path))
+    return 0
+
+
+def backup_command(args: argparse.Namespace) -> int:
+    password = read_password(args)
+    if (args.repository / "config").exists():
+        repo = Repository.open(args.repository, password)
+    else:
+        repo = Repository.create(args.repository, password)
+    if args.name and len(args.paths) > 1:
+        raise SystemExit("--name can only be given for a single folder or file.")
+    status = 0
+    for path in args.paths:
+        if not path.exists():
+            emit("result", file=str(path), status="error", error="not found")
+            status = 1
+            continue
+        last_report = 0.0
+        processed = 0
+        try:
+            for length in backup(path, repo, args.name):
+                processed += length
+                if time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                    last_report = time.monotonic()
+                    emit("progress", file=str(path), bytes=processed)
+        except ValueError as err:
+            emit("result", file=str(path), status="error", error=str(err))
+            status = 1
+        else:
+            emit("result", file=str(path), status="ok", **repo.stats)
+        repo.stats.clear()
+    return status
+
+
+def restore_command(args: argparse.Namespace) -> int:
+    repo = Repository.open(args.repository, read_password(args))
+    members = args.members or None
+    for _ in restore(repo, args.name, args.output, members, args.force):
+        pass
+    emit("result", file=str(args.output / args.name), status="ok")
+    return 0
+
+
+def prune_command(args: argparse.Namespace) -> int:
+    repo = Repository.open(args.repository, read_password(args))
+    emit("result", file=str(args.repository), status="ok", deleted=prune(repo))
+    return 0
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="vaultea", description="Easy to use file encryption app."
+    )
+    password = argparse.ArgumentParser(add_help=False)
+    group = password.add_mutually_exclusive_group()
+    group.add_argument(
+        "--password-stdin", action="store_true", help="read password from stdin"
+    )
+    group.add_argument(
+        "--password-fd", type=int, metavar="FD", help="read password from FD"
+    )
+    group.add_argument(
+        "--password-env", metavar="VAR", help="read password from environment"
+    )
+
+    inputs = argparse.ArgumentParser(add_help=False)
+    inputs.add_argument("inputs", nargs="+", help="files, folders or glob patterns")
+    inputs.add_argument(
+        "-r",
+        "--recursive",
+        action="store_true",
+        help="process every file inside given folders",
+    )
+    inputs.add_argument(
+        "--chunk-size",
+        type=parse_size,
+        default=None,
+        help="read size like 4M, or auto (default)",
+    )
+
+    events = argparse.ArgumentParser(add_help=False)
+    events.add_argument(
+        "--events",
+        action="store_true",
+        help="print per-file timings of key derivation, reading, cipher and writing",
+    )
+
+    workers = argparse.ArgumentParser(add_help=False)
+    workers.add_argument(
+        "-j", "--workers", type=int, help="worker processes (default: CPU count)"
+    )
+    workers.add_argument(
+        "--memory-budget",
+        type=parse_size,
+        default=DEFAULT_MEMORY_BUDGET,
+        help="RAM available to key derivation of parallel workers (default: 4G)",
+    )
+
+    processing = argparse.ArgumentParser(add_help=False, parents=[workers])
+    processing.add_argument("-o", "--output", type=Path, help="output folder")
+    processing.add_argument(
+        "-f", "--force", action="store_true", help="overwrite existing files"
+    )
+
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    encrypt_parser = commands.add_parser(
+        "encrypt", parents=[password, inputs, processing, events], help="encrypt files"
+    )
+    encrypt_parser.add_argument(
+        "--per-file-keys",
+        action="store_true",
+        help="derive the password key for every file instead of once per batch",
+    )
+    encrypt_parser.add_argument(
+        "--compress",
+        choices=available_algorithms(),
+        help="compress files before encryption, unless they turn out incompressible",
+    )
+    encrypt_parser.add_argument("--level", type=int, help="compression level")
+    encrypt_parser.set_defaults(handler=process_command)
+
+    decrypt_parser = commands.add_parser(
+        "decrypt", parents=[password, inputs, processing, events], help="decrypt files"
+    )
+    decrypt_parser.set_defaults(
+        handler=process_command, per_file_keys=False, compress=None, level=None
+    )
+
+    verify_parser = commands.add_parser(
+        "verify",
+        parents=[password, inputs, workers, events],
+        help="check integrity of encrypted files without decrypting them",
+    )
+    verify_parser.set_defaults(handler=verify_command)
+
+    inspect_parser = commands.add_parser(
+        "inspect", parents=[inputs], help="show header information of encrypted files"
+    )
+    inspect_parser.set_defaults(handler=inspect_command)
+
+    list_parser = commands.add_parser(
+        "list", parents=[password], help="list members of an encrypted folder"
+    )
+    list_parser.add_argument("archive", type=Path)
+    list_parser.set_defaults(handler=list_command)
+
+    extract_parser = commands.add_parser(
+        "extract",
+        parents=[password],
+        help="extract members of an encrypted folder without decrypting all of it",
+    )
+    extract_parser.add_argument("archive", type=Path)
+    extract_parser.add_argument("members", nargs="+")
+    extract_parser.add_argument(
+        "-o", "--output", type=Path, default=Path("."), help="output folder"
+    )
+    extract_parser.set_defaults(handler=extract_command)
+
+    backup_parser = commands.add_parser(
+        "backup",
+        parents=[password],
+        help="encrypt folders or files into a repository, storing only new data",
+    )
+    backup_parser.add_argument("repository", type=Path)
+    backup_parser.add_argument("paths", type=Path, nargs="+")
+    backup_parser.add_argument(
+        "--name", help="snapshot name (default: name of the folder or file)"
+    )
+    backup_parser.set_defaults(handler=backup_command)
+
+    restore_parser = commands.add_parser(
+        "restore", parents=[password], help="restore a folder or file from a repository"
+    )
+    restore_parser.add_argument("repository", type=Path)
+    restore_parser.add_argument(
+        "name", help="snapshot name, by default that of the backed up folder or file"
+    )
+    restore_parser.add_argument("members", nargs="*", help="restore only these")
+    restore_parser.add_argument(
+        "-o", "--output", type=Path, default=Path("."), help="output folder"
+    )
+    restore_parser.add_argument(
+        "-f", "--force", action="store_true", help="overwrite existing files"
+    )
+    restore_parser.set_defaults(handler=restore_command)
+
+    prune_parser = commands.add_parser(
+        "prune",
+        parents=[password],
+        help="delete data of a repository no folder refers to anymore",
+    )
+    prune_parser.add_argument("repository", type=Path)
+    prune_parser.set_defaults(handler=prune_command)
+
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = parse_args(argv)
+    try:
+        return args.handler(args)
+    except KeyError:
+        emit("error", error="incorrect password or not an encrypted folder")
+        return 1
+    except (ValueError, OSError) as err:
+        emit("error", error=str(err))
+        return 1
+
+
+def run() -> None:
+    """Entry point of the vaultea command."""
+    mp.freeze_support()
+    sys.exit(main())
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,239 @@
+import time
+import zlib
+from pathlib import Path
+from typing import BinaryIO, Iterator
+
+from container import (
+    COMPRESSION_ZLIB,
+    COMPRESSION_ZSTD,
+    HEADER_SIZE,
+    SEGMENT_SIZE,
+    TAG_SIZE,
+    Header,
+    SegmentWriter,
+    chunk_segments,
+    decrypt_segments,
+    iter_chunks,
+)
+from timing import PhaseTimer
+
+try:
+    import zstandard
+except ImportError:  # Optional, zlib is always available
+    zstandard = None
+
+# Optional compression of the plaintext before encryption.
+#
+# The algorithm is stored in the flags of the container header, which is
+# authenticated along with every segment. Compressed containers hold a single
+# zlib or zstd stream, so they are processed sequentially and have no random access.
+
+ALGORITHMS = {"zlib": COMPRESSION_ZLIB, "zstd": COMPRESSION_ZSTD}
+SAMPLE_SIZE = 64 * 1024  # Bytes compressed from every sampled position
+SAMPLE_FILES = 16  # Files of a folder sampled at most
+COMPRESSIBLE_RATIO = 0.9  # Sample must shrink at least this much to compress the data
+# Decompressed output is produced in pieces of about this size, so data that
+# compresses extremely well (e.g. zeros) doesn't expand into memory all at once.
+DECOMPRESS_SIZE = 4 * 1024 * 1024  # 4 MiB
+# zstd can't limit its output, so its input is fed in pieces instead. A 4 byte
+# block expands into at most 128 KiB, so a piece yields at most 32768 times its
+# size (8 MiB), and output is written in pieces of at most 12 MiB.
+ZSTD_INPUT_SIZE = 256
+
+
+def available_algorithms() -> list[str]:
+    return [name for name in ALGORITHMS if name != "zstd" or zstandard]
+
+
+def compression_name(algorithm: int) -> str | None:
+    return next((name for name, id in ALGORITHMS.items() if id == algorithm), None)
+
+
+def compressor(algorithm: int, level: int | None = None, threads: int = 1):
+    """Streaming compressor with compress() and flush(). zstd uses threads."""
+    if algorithm == COMPRESSION_ZLIB:
+        return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if level is None else level)
+    check_zstd()
+    return zstandard.ZstdCompressor(
+        level=3 if level is None else level, threads=threads if threads > 1 else 0
+    ).compressobj()
+
+
+def decompressor(algorithm: int):
+    """Streaming decompressor with decompress() and eof."""
+    if algorithm == COMPRESSION_ZLIB:
+        return zlib.decompressobj()
+    check_zstd()
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def check_zstd() -> None:
+    if zstandard is None:
+        raise RuntimeError("zstd compression requires the zstandard package")
+
+
+def samples(path: Path) -> Iterator[bytes]:
+    """Pieces of a file (its start, middle and end) or of the first files of
+    a folder."""
+    if path.is_dir():
+        members = (member for member in path.rglob("*") if member.is_file())
+        for _, member in zip(range(SAMPLE_FILES), members):
+            with open(member, "rb") as file:
+                yield file.read(SAMPLE_SIZE)
+        return
+
+    size = path.stat().st_size
+    with open(path, "rb") as file:
+        for offset in sorted({0, (size - SAMPLE_SIZE) // 2, size - SAMPLE_SIZE}):
+            file.seek(max(0, offset))
+            yield file.read(SAMPLE_SIZE)
+
+
+def is_compressible(path: Path) -> bool:
+    """Tell from samples compressed at the fastest level whether compressing the
+    file or folder is worth it. Already compressed data (media, archives) isn't."""
+    original = compressed = 0
+    for sample in samples(path):
+        original += len(sample)
+        compressed += len(zlib.compress(sample, 1))
+    return compressed < original * COMPRESSIBLE_RATIO
+
+
+class CompressingWriter:
+    """Write-only file-like object that compresses everything written to it into
+    sink, e.g. a SegmentWriter. close() finishes the stream but leaves sink open."""
+
+    def __init__(
+        self,
+        sink: BinaryIO,
+        algorithm: int,
+        level: int | None = None,
+        threads: int = 1,
+        timer: PhaseTimer | None = None,
+    ) -> None:
+        self.sink = sink
+        self.compressor = compressor(algorithm, level, threads)
+        self.timer = timer or PhaseTimer()
+        self.closed = False
+
+    def write(self, data) -> int:
+        with self.timer.phase("compress", len(data)):
+            compressed = self.compressor.compress(data)
+        if compressed:
+            self.sink.write(compressed)
+        return len(data)
+
+    def flush(self) -> None:
+        pass  # Flushing the compressor would make the stream larger
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        with self.timer.phase("compress"):
+            self.sink.write(self.compressor.flush())
+        self.closed = True
+
+
+def encrypt_compressed(
+    src: Path,
+    dst: Path,
+    key: bytes,
+    header: Header,
+    chunk_size: int = SEGMENT_SIZE,
+    level: int | None = None,
+    threads: int = 1,
+    timer: PhaseTimer | None = None,
+) -> Iterator[int]:
+    """Compress src with the algorithm in header flags and encrypt it into a new
+    container dst. Yields number of plaintext bytes processed."""
+    timer = timer or PhaseTimer()
+    with open(src, "rb") as f_in, open(dst, "wb") as f_out:
+        writer = SegmentWriter(f_out, key, header, timer)
+        compressing = CompressingWriter(
+            writer, header.compression, level, threads, timer
+        )
+        for chunk, _ in iter_chunks(f_in, chunk_size, timer):
+            compressing.write(chunk)
+            yield len(chunk)
+        compressing.close()
+        writer.close()  # Write the last segment
+
+
+class DecompressingWriter:
+    """Write-only file-like object that decompresses everything written to it into
+    sink in bounded pieces (see DECOMPRESS_SIZE and ZSTD_INPUT_SIZE). close() raises
+    ValueError if the stream isn't complete, but leaves sink open."""
+
+    def __init__(
+        self, sink: BinaryIO, algorithm: int, timer: PhaseTimer | None = None
+    ) -> None:
+        self.sink = sink
+        self.algorithm = algorithm
+        self.decompressor = decompressor(algorithm)
+        self.timer = timer or PhaseTimer()
+
+    def write(self, data) -> int:
+        for piece in self.pieces(memoryview(data)):
+            with self.timer.phase("write", len(piece)):
+                self.sink.write(piece)
+        return len(data)
+
+    def pieces(self, data: memoryview) -> Iterator[bytes]:
+        stream = self.decompressor
+        if self.algorithm == COMPRESSION_ZLIB:
+            while not stream.eof:
+                with self.timer.phase("compress", len(data)):
+                    piece = stream.decompress(data, DECOMPRESS_SIZE)
+                data = memoryview(stream.unconsumed_tail)
+                yield piece
+                # A full piece may leave output pending even if all input is used
+                if not data and len(piece) < DECOMPRESS_SIZE:
+                    return
+            return
+
+        start = 0
+        while start < len(data) and not stream.eof:
+            # Timed per batch of input pieces, as there are many small ones
+            batch_start, pieces, size = start, [], 0
+            begin = time.perf_counter()
+            while start < len(data) and size < DECOMPRESS_SIZE and not stream.eof:
+                pieces.append(stream.decompress(data[start : start + ZSTD_INPUT_SIZE]))
+                size += len(pieces[-1])
+                start += ZSTD_INPUT_SIZE
+            consumed = min(start, len(data)) - batch_start
+            self.timer.add("compress", time.perf_counter() - begin, consumed)
+            yield b"".join(pieces)
+
+    def close(self) -> None:
+        if not self.decompressor.eof:
+            raise ValueError("Truncated compressed stream")
+
+
+def decrypt_compressed(
+    src: Path,
+    dst: Path,
+    key: bytes,
+    header: Header,
+    chunk_size: int = SEGMENT_SIZE,
+    timer: PhaseTimer | None = None,
+) -> Iterator[int]:
+    """Decrypt container src and decompress it into dst. Yields number of encrypted
+    bytes processed. Only verified segments are decompressed."""
+    timer = timer or PhaseTimer()
+    header_bytes = header.pack()
+    segments = chunk_segments(chunk_size, header.segment_size)
+    output = memoryview(bytearray(segments * header.segment_size))
+    index = 0
+    with open(src, "rb") as f_in, open(dst, "wb") as f_out:
+        writer = DecompressingWriter(f_out, header.compression, timer)
+        f_in.seek(HEADER_SIZE)
+        block_size = header.segment_size + TAG_SIZE
+        for chunk, last in iter_chunks(f_in, segments * block_size, timer):
+            with timer.phase("cipher", len(chunk)):
+                written, count = decrypt_segments(
+                    chunk, output, key, header, header_bytes, index, last
+                )
+            writer.write(output[:written])
+            index += count
+            yield len(chunk)
+        writer.close()
@@ -0,0 +1,1101 @@
+import io
+import mmap
+import os
+import queue
+import stat
+import struct
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Callable, Iterator
+
+from Crypto.Cipher import ChaCha20, ChaCha20_Poly1305
+from Crypto.Hash import Poly1305
+
+from timing import PhaseTimer
+
+# Segmented container (version 2).
+#
+# The header is followed by independently authenticated segments. Every segment
+# holds up to segment_size bytes of ciphertext followed by its 16 byte tag. Segment
+# nonce is nonce_prefix + 32-bit big endian segment index + last segment flag byte,
+# so segments can't be reordered, dropped or truncated unnoticed. The header is
+# authenticated as associated data of every segment.
+#
+# Bits 0-1 of the header flags tell the algorithm the plaintext was compressed with
+# before encryption (see compress.py), other bits are reserved.
+
+MAGIC = b"TEAX"
+VERSION = 2
+SEGMENT_SIZE = 1024 * 1024  # 1 MiB
+MIN_SEGMENT_SIZE = 1024  # 1 KiB
+MAX_SEGMENT_SIZE = 64 * 1024 * 1024  # 64 MiB
+TAG_SIZE = 16
+MAX_SEGMENTS = 2**32
+RANGE_SEGMENTS = 64  # Segments per task when processing a file in parallel
+MAP_SEGMENTS = 4  # Segments per task of memory mapped engines, see unmap_range
+PIPELINE_DEPTH = 4  # Buffers per pipeline side
+PIPELINE_MEMORY = 64 * 1024 * 1024  # Upper limit of pipeline buffers, 64 MiB
+# RAM a single key derivation of a file may ask for (128 * r * N bytes), 4 times
+# that of the parameters Vaultea writes. Headers aren't authenticated before the
+# key is derived, so a junk or crafted file must not be able to exhaust memory.
+MAX_SCRYPT_MEMORY = 4 * 1024**3  # 4 GiB
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+COMPRESSION_MASK = 0x03
+
+HEADER_FORMAT = ">4sBBBBBI16s12s16s32s7s"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)  # = 96 bytes
+
+
+@dataclass(frozen=True)
+class Header:
+    salt: bytes
+    key_nonce: bytes
+    key_tag: bytes
+    key_encrypted: bytes
+    nonce_prefix: bytes
+    scrypt_log2_n: int
+    scrypt_r: int
+    scrypt_p: int
+    segment_size: int = SEGMENT_SIZE
+    flags: int = 0
+
+    @property
+    def scrypt_n(self) -> int:
+        return 2**self.scrypt_log2_n
+
+    @property
+    def scrypt_memory(self) -> int:
+        """RAM needed by scrypt with the parameters of this header."""
+        return 128 * self.scrypt_r * self.scrypt_n
+
+    @property
+    def compression(self) -> int:
+        return self.flags & COMPRESSION_MASK
+
+    def pack(self) -> bytes:
+        return struct.pack(
+            HEADER_FORMAT,
+            MAGIC,
+            VERSION,
+            self.flags,
+            self.scrypt_log2_n,
+            self.scrypt_r,
+            self.scrypt_p,
+            self.segment_size,
+            self.salt,
+            self.key_nonce,
+            self.key_tag,
+            self.key_encrypted,
+            self.nonce_prefix,
+        )
+
+    @classmethod
+    def unpack(cls, data: bytes) -> "Header | None":
+        """Parse version 2 header. Returns None if data doesn't start with one."""
+        if len(data) < HEADER_SIZE or not data.startswith(MAGIC):
+            return None
+        (
+            _,
+            version,
+            flags,
+            scrypt_log2_n,
+            scrypt_r,
+            scrypt_p,
+            segment_size,
+            salt,
+            key_nonce,
+            key_tag,
+            key_encrypted,
+            nonce_prefix,
+        ) = struct.unpack(HEADER_FORMAT, data[:HEADER_SIZE])
+        if version != VERSION:
+            return None
+
+        # Refuse parameters that would make reading the file unreasonably expensive
+        if not (
+            10 <= scrypt_log2_n <= 22
+            and 1 <= scrypt_r <= 32
+            and 1 <= scrypt_p <= 16
+            and 128 * scrypt_r * 2**scrypt_log2_n <= MAX_SCRYPT_MEMORY
+            and MIN_SEGMENT_SIZE <= segment_size <= MAX_SEGMENT_SIZE
+            and flags & COMPRESSION_MASK <= COMPRESSION_ZSTD
+            and not flags & ~COMPRESSION_MASK
+        ):
+            raise ValueError("Unsupported container parameters")
+
+        return cls(
+            salt=salt,
+            key_nonce=key_nonce,
+            key_tag=key_tag,
+            key_encrypted=key_encrypted,
+            nonce_prefix=nonce_prefix,
+            scrypt_log2_n=scrypt_log2_n,
+            scrypt_r=scrypt_r,
+            scrypt_p=scrypt_p,
+            segment_size=segment_size,
+            flags=flags,
+        )
+
+
+def read_header(f_in: BinaryIO) -> Header | None:
+    """Read version 2 header from the current position of f_in.
+    If there is none, f_in is rewound to where it was."""
+    start = f_in.tell()
+    header = Header.unpack(f_in.read(HEADER_SIZE))
+    if header is None:
+        f_in.seek(start)
+    return header
+
+
+def read_file_header(path: Path) -> Header | None:
+    with open(path, "rb") as file:
+        return read_header(file)
+
+
+def segment_cipher(
+    key: bytes, header: Header, header_bytes: bytes, index: int, last: bool
+):
+    nonce = segment_nonce(header, index, last)
+    cipher = ChaCha20_Poly1305.new(key=key, nonce=nonce)
+    cipher.update(header_bytes)
+    return cipher
+
+
+def segment_nonce(header: Header, index: int, last: bool) -> bytes:
+    if index >= MAX_SEGMENTS:
+        raise OverflowError("Too many segments")
+    return header.nonce_prefix + index.to_bytes(4, "big") + bytes([last])
+
+
+def aead_mac(key: bytes, nonce: bytes, aad: bytes):
+    """Poly1305 MAC of ChaCha20-Poly1305 (RFC 8439) with associated data absorbed.
+    Ciphertext can be fed to it in parts, see aead_verify."""
+    mac = Poly1305.new(key=key, nonce=nonce, cipher=ChaCha20)
+    mac.update(aad)
+    mac.update(bytes(-len(aad) % 16))
+    return mac
+
+
+def aead_verify(mac, aad_length: int, ciphertext_length: int, tag: bytes) -> None:
+    """Check tag of the ciphertext fed to mac without decrypting it, which only
+    costs Poly1305. Raises ValueError if it doesn't match."""
+    mac.update(bytes(-ciphertext_length % 16))
+    mac.update(struct.pack("<QQ", aad_length, ciphertext_length))
+    mac.verify(tag)
+
+
+def read_into(f_in: BinaryIO, view: memoryview) -> int:
+    """Fill view from f_in. Returns less than len(view) only at the end of file."""
+    total = 0
+    while total < len(view):
+        if not (read := f_in.readinto(view[total:])):
+            break
+        total += read
+    return total
+
+
+def encrypt_segments(
+    plaintext: memoryview,
+    output: memoryview,
+    key: bytes,
+    header: Header,
+    header_bytes: bytes,
+    first: int,
+    last: bool,
+) -> tuple[int, int]:
+    """Encrypt plaintext, holding whole segments (only the final one may be shorter),
+    into output without intermediate copies. If last is set, the final segment
+    is marked as the last one of the file.
+    Returns number of bytes written to output and number of segments."""
+    segment_size = header.segment_size
+    count = segment_count(len(plaintext), segment_size)
+    written = 0
+    for i in range(count):
+        part = plaintext[i * segment_size : (i + 1) * segment_size]
+        end = written + len(part)
+        cipher = segment_cipher(
+            key, header, header_bytes, first + i, last and i == count - 1
+        )
+        if part:
+            cipher.encrypt(part, output=output[written:end])
+        output[end : end + TAG_SIZE] = cipher.digest()
+        written = end + TAG_SIZE
+    return written, count
+
+
+def decrypt_segments(
+    ciphertext: memoryview,
+    output: memoryview,
+    key: bytes,
+    header: Header,
+    header_bytes: bytes,
+    first: int,
+    last: bool,
+) -> tuple[int, int]:
+    """Decrypt and verify whole segments (only the final one may be shorter) into
+    output. Raises ValueError if any of them fails authentication.
+    Returns number of bytes written to output and number of segments."""
+    block_size = header.segment_size + TAG_SIZE
+    count = max(1, -(-len(ciphertext) // block_size))
+    written = 0
+    for i in range(count):
+        block = ciphertext[i * block_size : (i + 1) * block_size]
+        if len(block) < TAG_SIZE:
+            raise ValueError("Truncated segment")
+        end = written + len(block) - TAG_SIZE
+        cipher = segment_cipher(
+            key, header, header_bytes, first + i, last and i == count - 1
+        )
+        if end > written:
+            cipher.decrypt(block[:-TAG_SIZE], output=output[written:end])
+        cipher.verify(block[-TAG_SIZE:])
+        written = end
+    return written, count
+
+
+def verify_segments(
+    ciphertext: memoryview,
+    key: bytes,
+    header: Header,
+    header_bytes: bytes,
+    first: int,
+    last: bool,
+) -> int:
+    """Authenticate whole segments (only the final one may be shorter) without
+    decrypting them. Raises ValueError if any of them fails.
+    Returns number of segments."""
+    block_size = header.segment_size + TAG_SIZE
+    count = max(1, -(-len(ciphertext) // block_size))
+    for i in range(count):
+        block = ciphertext[i * block_size : (i + 1) * block_size]
+        if len(block) < TAG_SIZE:
+            raise ValueError("Truncated segment")
+        nonce = segment_nonce(header, first + i, last and i == count - 1)
+        mac = aead_mac(key, nonce, header_bytes)
+        mac.update(block[:-TAG_SIZE])
+        aead_verify(mac, len(header_bytes), len(block) - TAG_SIZE, block[-TAG_SIZE:])
+    return count
+
+
+def iter_chunks(
+    f_in: BinaryIO, chunk_size: int, timer: PhaseTimer | None = None
+) -> Iterator[tuple[memoryview, bool]]:
+    """Read f_in in chunks using two preallocated buffers in turns. Every chunk
+    is yielded along with the flag whether it is the last one, which is known
+    because the following chunk is already read by then. Chunk views are only
+    valid until the next iteration."""
+    timer = timer or PhaseTimer()
+    buffers = memoryview(bytearray(chunk_size)), memoryview(bytearray(chunk_size))
+    with timer.phase("read"):
+        length = read_into(f_in, buffers[0])
+    current = 0
+    while True:
+        with timer.phase("read"):
+            next_length = read_into(f_in, buffers[1 - current])
+        timer.add("read", 0, length)
+        last = next_length == 0
+        yield buffers[current][:length], last
+        if last:
+            return
+        current, length = 1 - current, next_length
+
+
+class SegmentWriter:
+    """Write-only file-like object that encrypts everything written to it
+    into segments. The header is written on creation, close() writes the last segment.
+    """
+
+    def __init__(
+        self,
+        f_out: BinaryIO,
+        key: bytes,
+        header: Header,
+        timer: PhaseTimer | None = None,
+    ) -> None:
+        self.f_out = f_out
+        self.key = key
+        self.header = header
+        self.timer = timer or PhaseTimer()
+        self.header_bytes = header.pack()
+        self.buffer = memoryview(bytearray(header.segment_size))
+        self.output = memoryview(bytearray(header.segment_size + TAG_SIZE))
+        self.filled = 0
+        self.index = 0
+        self.closed = False
+        f_out.write(self.header_bytes)
+
+    def write(self, data) -> int:
+        view = memoryview(data).cast("B")
+        segment_size = self.header.segment_size
+        while view:
+            # A full segment is only written once more data comes,
+            # until then it might turn out to be the last one
+            if self.filled == segment_size:
+                self.write_segment(last=False)
+            length = min(len(view), segment_size - self.filled)
+            self.buffer[self.filled : self.filled + length] = view[:length]
+            self.filled += length
+            view = view[length:]
+        return len(data)
+
+    def write_segment(self, last: bool) -> None:
+        with self.timer.phase("cipher", self.filled):
+            written, _ = encrypt_segments(
+                self.buffer[: self.filled],
+                self.output,
+                self.key,
+                self.header,
+                self.header_bytes,
+                self.index,
+                last,
+            )
+        with self.timer.phase("write", written):
+            self.f_out.write(self.output[:written])
+        self.filled = 0
+        self.index += 1
+
+    def flush(self) -> None:
+        self.f_out.flush()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.write_segment(last=True)
+        self.closed = True
+
+
+class SegmentReader(io.RawIOBase):
+    """Seekable read-only file-like object over the plaintext of a container.
+    Only the segments covering requested ranges are read, each one is verified
+    before any of its data is returned."""
+
+    def __init__(self, f_in: BinaryIO, key: bytes, header: Header) -> None:
+        super().__init__()
+        self.f_in = f_in
+        self.key = key
+        self.header = header
+        self.header_bytes = header.pack()
+        f_in.seek(0, os.SEEK_END)
+        self.size, self.count = decrypted_size(f_in.tell(), header.segment_size)
+        self.position = 0
+        self.segments_read = 0
+        self.cached: tuple[int, bytes] | None = None
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("Negative seek position")
+        self.position = offset
+        return offset
+
+    def readinto(self, buffer) -> int:
+        segment_size = self.header.segment_size
+        view = memoryview(buffer).cast("B")
+        written = 0
+        while written < len(view) and self.position < self.size:
+            index, offset = divmod(self.position, segment_size)
+            segment = self.segment(index)[offset:]
+            length = min(len(segment), len(view) - written)
+            view[written : written + length] = segment[:length]
+            written += length
+            self.position += length
+        return written
+
+    def segment(self, index: int) -> bytes:
+        """Read, decrypt and verify a single segment."""
+        if self.cached and self.cached[0] == index:
+            return self.cached[1]
+        block_size = self.header.segment_size + TAG_SIZE
+        self.f_in.seek(HEADER_SIZE + index * block_size)
+        block = self.f_in.read(block_size)
+        if len(block) < TAG_SIZE:
+            raise ValueError("Truncated segment")
+        last = index == self.count - 1
+        cipher = segment_cipher(self.key, self.header, self.header_bytes, index, last)
+        plaintext = cipher.decrypt_and_verify(block[:-TAG_SIZE], block[-TAG_SIZE:])
+        self.segments_read += 1
+        self.cached = index, plaintext
+        return plaintext
+
+
+def chunk_segments(chunk_size: int, segment_size: int) -> int:
+    """Number of whole segments processed per I/O call."""
+    return max(1, chunk_size // segment_size)
+
+
+def encrypt_stream(
+    src: Path,
+    dst: Path,
+    key: bytes,
+    header: Header,
+    chunk_size: int = SEGMENT_SIZE,
+    timer: PhaseTimer | None = None,
+) -> Iterator[int]:
+    """Encrypt src into a new container dst. Yields number of plaintext bytes processed.
+    All buffers are allocated once, chunk_size is rounded to whole segments."""
+    timer = timer or PhaseTimer()
+    header_bytes = header.pack()
+    segments = chunk_segments(chunk_size, header.segment_size)
+    output = memoryview(bytearray(segments * (header.segment_size + TAG_SIZE)))
+    index = 0
+    with open(src, "rb") as f_in, open(dst, "wb") as f_out:
+        f_out.write(header_bytes)
+        for chunk, last in iter_chunks(f_in, segments * header.segment_size, timer):
+            with timer.phase("cipher", len(chunk)):
+                written, count = encrypt_segments(
+                    chunk, output, key, header, header_bytes, index, last
+                )
+            with timer.phase("write", written):
+                f_out.write(output[:written])
+            index += count
+            yield len(chunk)
+
+
+def decrypt_stream(
+    src: Path,
+    dst: Path,
+    key: bytes,
+    header: Header,
+    chunk_size: int = SEGMENT_SIZE,
+    timer: PhaseTimer | None = None,
+) -> Iterator[int]:
+    """Decrypt container src into dst. Yields number of encrypted bytes processed.
+    Only verified segments are written. All buffers are allocated once."""
+    timer = timer or PhaseTimer()
+    header_bytes = header.pack()
+    segments = chunk_segments(chunk_size, header.segment_size)
+    output = memoryview(bytearray(segments * header.segment_size))
+    index = 0
+    with open(src, "rb") as f_in, open(dst, "wb") as f_out:
+        f_in.seek(HEADER_SIZE)
+        block_size = header.segment_size + TAG_SIZE
+        for chunk, last in iter_chunks(f_in, segments * block_size, timer):
+            with timer.phase("cipher", len(chunk)):
+                written, count = decrypt_segments(
+                    chunk, output, key, header, header_bytes, index, last
+                )
+            with timer.phase("write", written):
+                f_out.write(output[:written])
+            index += count
+            yield len(chunk)
+
+
+class Pipeline:
+    """Reader thread -> cipher stage (the calling thread) -> writer thread, connected
+    by queues of reused buffers, so the source and destination devices are kept busy
+    while the cipher runs. Every side has PIPELINE_DEPTH buffers. A stage waits
+    for a free buffer when the next one is behind, which keeps memory use fixed."""
+
+    def __init__(
+        self,
+        f_in: BinaryIO,
+        f_out: BinaryIO,
+        input_size: int,
+        output_size: int,
+        timer: PhaseTimer | None = None,
+    ) -> None:
+        self.f_in = f_in
+        self.f_out = f_out
+        self.timer = timer or PhaseTimer()
+        self.free_input: queue.Queue = queue.Queue()
+        self.free_output: queue.Queue = queue.Queue()
+        for _ in range(PIPELINE_DEPTH):
+            self.free_input.put(memoryview(bytearray(input_size)))
+            self.free_output.put(memoryview(bytearray(output_size)))
+        self.filled: queue.Queue = queue.Queue()
+        self.pending: queue.Queue = queue.Queue()
+        self.stop = threading.Event()
+        self.error: BaseException | None = None
+        self.reader = threading.Thread(target=self.read, daemon=True)
+        self.writer = threading.Thread(target=self.write, daemon=True)
+
+    def __enter__(self) -> "Pipeline":
+        self.reader.start()
+        self.writer.start()
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.stop.set()
+        self.pending.put(None)
+        self.reader.join()
+        self.writer.join()
+
+    def read(self) -> None:
+        try:
+            while not self.stop.is_set():
+                try:
+                    buffer = self.free_input.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                with self.timer.phase("read"):
+                    length = read_into(self.f_in, buffer)
+                self.timer.add("read", 0, length)
+                if not length:
+                    break
+                self.filled.put((buffer, length))
+        except BaseException as err:
+            self.error = err
+        finally:
+            self.filled.put(None)  # End of input
+
+    def write(self) -> None:
+        try:
+            while item := self.pending.get():  # Walrus
+                buffer, length = item
+                with self.timer.phase("write", length):
+                    self.f_out.write(buffer[:length])
+                self.free_output.put(buffer)
+        except BaseException as err:
+            self.error = err
+            self.stop.set()
+
+    def chunks(self) -> Iterator[tuple[memoryview, bool]]:
+        """Yield chunks of input along with the flag whether it is the last one.
+        Chunk views are only valid until the next iteration."""
+        current = self.filled.get()
+        while True:
+            following = self.filled.get() if current else None
+            if self.error:
+                raise self.error
+            if not current:  # Empty input
+                yield memoryview(b""), True
+                return
+            buffer, length = current
+            yield buffer[:length], following is None
+            self.free_input.put(buffer)
+            if following is None:
+                return
+            current = following
+
+    def output(self) -> memoryview:
+        """Get a free output buffer, waiting for the writer if there is none."""
+        while True:
+            if self.error:
+                raise self.error
+            try:
+                return self.free_output.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+    def submit(self, buffer: memoryview, length: int) -> None:
+        """Queue length bytes of output buffer to be written."""
+        self.pending.put((buffer, length))
+
+    def finish(self) -> None:
+        """Wait for all output to be written."""
+        self.pending.put(None)
+        self.writer.join()
+        if self.error:
+            raise self.error
+
+
+def pipeline_segments(chunk_size: int, block_size: int) -> int:
+    """Segments per pipeline chunk, limited by PIPELINE_MEMORY."""
+    limit = PIPELINE_MEMORY // (2 * PIPELINE_DEPTH * block_size)
+    return max(1, min(chunk_size // block_size, limit))
+
+
+def encrypt_pipelined(
+    src: Path,
+    dst: Path,
+    key: bytes,
+    header: Header,
+    chunk_size: int = SEGMENT_SIZE,
+    timer: PhaseTimer | None = None,
+) -> Iterator[int]:
+    """Same as encrypt_stream, but reading and writing run in their own threads
+    (see Pipeline). Yields number of plaintext bytes processed."""
+    timer = timer or PhaseTimer()
+    header_bytes = header.pack()
+    block_size = header.segment_size + TAG_SIZE
+    segments = pipeline_segments(chunk_size, block_size)
+    index = 0
+    with open(src, "rb") as f_in, open(dst, "wb") as f_out:
+        f_out.write(header_bytes)
+        with Pipeline(
+            f_in, f_out, segments * header.segment_size, segments * block_size, timer
+        ) as pipeline:
+            for chunk, last in pipeline.chunks():
+                output = pipeline.output()
+                with timer.phase("cipher", len(chunk)):
+                    written, count = encrypt_segments(
+                        chunk, output, key, header, header_bytes, index, last
+                    )
+                pipeline.submit(output, written)
+                index += count
+                yield len(chunk)
+            pipeline.finish()
+
+
+def decrypt_pipelined(
+    src: Path,
+    dst: Path,
+    key: bytes,
+    header: Header,
+    chunk_size: int = SEGMENT_SIZE,
+    timer: PhaseTimer | None = None,
+) -> Iterator[int]:
+    """Same as decrypt_stream, but reading and writing run in their own threads
+    (see Pipeline). Yields number of encrypted bytes processed."""
+    timer = timer or PhaseTimer()
+    header_bytes = header.pack()
+    block_size = header.segment_size + TAG_SIZE
+    segments = pipeline_segments(chunk_size, block_size)
+    index = 0
+    with open(src, "rb") as f_in, open(dst, "wb") as f_out:
+        f_in.seek(HEADER_SIZE)
+        with Pipeline(
+            f_in, f_out, segments * block_size, segments * header.segment_size, timer
+        ) as pipeline:
+            for chunk, last in pipeline.chunks():
+                output = pipeline.output()
+                with timer.phase("cipher", len(chunk)):
+                    written, count = decrypt_segments(
+                        chunk, output, key, header, header_bytes, index, last
+                    )
+                pipeline.submit(output, written)
+                index += count
+                yield len(chunk)
+            pipeline.finish()
+
+
+def verify_stream(
+    src: Path,
+    key: bytes,
+    header: Header,
+    chunk_size: int = SEGMENT_SIZE,
+    timer: PhaseTimer | None = None,
+) -> Iterator[int]:
+    """Authenticate every segment of container src, nothing is decrypted or written.
+    Raises ValueError on the first corrupt segment.
+    Yields number of encrypted bytes processed."""
+    timer = timer or PhaseTimer()
+    header_bytes = header.pack()
+    block_size = header.segment_size + TAG_SIZE
+    segments = chunk_segments(chunk_size, header.segment_size)
+    index = 0
+    with open(src, "rb") as f_in:
+        f_in.seek(HEADER_SIZE)
+        for chunk, last in iter_chunks(f_in, segments * block_size, timer):
+            with timer.phase("cipher", len(chunk)):
+                index += verify_segments(chunk, key, header, header_bytes, index, last)
+            yield len(chunk)
+
+
+def segment_count(plaintext_size: int, segment_size: int) -> int:
+    # Even an empty file has one (empty) last segment
+    return max(1, -(-plaintext_size // segment_size))
+
+
+def encrypted_size(plaintext_size: int, segment_size: int) -> int:
+    segments = segment_count(plaintext_size, segment_size)
+    return HEADER_SIZE + plaintext_size + segments * TAG_SIZE
+
+
+def decrypted_size(encrypted_size: int, segment_size: int) -> tuple[int, int]:
+    """Return plaintext size and segment count of a container of given size."""
+    payload = encrypted_size - HEADER_SIZE
+    segments = max(1, -(-payload // (segment_size + TAG_SIZE)))
+    plaintext_size = payload - segments * TAG_SIZE
+    if plaintext_size < (segments - 1) * segment_size:
+        raise ValueError("Truncated segment")
+    return plaintext_size, segments
+
+
+def encrypt_range(
+    src: Path,
+    dst: Path,
+    key: bytes,
+    header: Header,
+    first: int,
+    stop: int,
+    count: int,
+    timer: PhaseTimer,
+) -> int:
+    """Encrypt segments [first, stop) of src into their place in dst."""
+    header_bytes = header.pack()
+    segment_size = header.segment_size
+    buffer = memoryview(bytearray(segment_size))
+    output = memoryview(bytearray(segment_size + TAG_SIZE))
+    processed = 0
+    with open(src, "rb") as f_in, open(dst, "r+b") as f_out:
+        f_in.seek(first * segment_size)
+        f_out.seek(HEADER_SIZE + first * (segment_size + TAG_SIZE))
+        for index in range(first, stop):
+            with timer.phase("read"):
+                length = read_into(f_in, buffer)
+            timer.add("read", 0, length)
+            with timer.phase("cipher", length):
+                written, _ = encrypt_segments(
+                    buffer[:length],
+                    output,
+                    key,
+                    header,
+                    header_bytes,
+                    index,
+                    index == count - 1,
+                )
+            with timer.phase("write", written):
+                f_out.write(output[:written])
+            processed += length
+    return processed
+
+
+def decrypt_range(
+    src: Path,
+    dst: Path,
+    key: bytes,
+    header: Header,
+    first: int,
+    stop: int,
+    count: int,
+    timer: PhaseTimer,
+) -> int:
+    """Decrypt and verify segments [first, stop) of src into their place in dst."""
+    header_bytes = header.pack()
+    segment_size = header.segment_size
+    buffer = memoryview(bytearray(segment_size + TAG_SIZE))
+    output = memoryview(bytearray(segment_size))
+    processed = 0
+    with open(src, "rb") as f_in, open(dst, "r+b") as f_out:
+        f_in.seek(HEADER_SIZE + first * (segment_size + TAG_SIZE))
+        f_out.seek(first * segment_size)
+        for index in range(first, stop):
+            with timer.phase("read"):
+                length = read_into(f_in, buffer)
+            timer.add("read", 0, length)
+            with timer.phase("cipher", length):
+                written, _ = decrypt_segments(
+                    buffer[:length],
+                    output,
+                    key,
+                    header,
+                    header_bytes,
+                    index,
+                    index == count - 1,
+                )
+            with timer.phase("write", written):
+                f_out.write(output[:written])
+            processed += length
+    return processed
+
+
+def verify_range(
+    src: Path,
+    dst: Path | None,
+    key: bytes,
+    header: Header,
+    first: int,
+    stop: int,
+    count: int,
+    timer: PhaseTimer,
+) -> int:
+    """Authenticate segments [first, stop) of src. dst is not used."""
+    header_bytes = header.pack()
+    block_size = header.segment_size + TAG_SIZE
+    buffer = memoryview(bytearray(block_size))
+    processed = 0
+    with open(src, "rb") as f_in:
+        f_in.seek(HEADER_SIZE + first * block_size)
+        for index in range(first, stop):
+            with timer.phase("read"):
+                length = read_into(f_in, buffer)
+            timer.add("read", 0, length)
+            with timer.phase("cipher", length):
+                verify_segments(
+                    buffer[:length],
+                    key,
+                    header,
+                    header_bytes,
+                    index,
+                    index == count - 1,
+                )
+            processed += length
+    return processed
+
+
+def process_ranges(
+    process_range: Callable[..., int],
+    src: Path,
+    dst: Path | None,
+    key: bytes,
+    header: Header,
+    count: int,
+    threads: int,
+    timer: PhaseTimer | None = None,
+) -> Iterator[int]:
+    """Process segment ranges concurrently, yielding bytes processed by each range.
+    The cipher releases the GIL, so throughput scales with threads."""
+    timer = timer or PhaseTimer()
+    executor = ThreadPoolExecutor(max_workers=threads)
+    try:
+        futures = [
+            executor.submit(
+                process_range,
+                src,
+                dst,
+                key,
+                header,
+                first,
+                min(first + RANGE_SEGMENTS, count),
+                count,
+                timer,
+            )
+            for first in range(0, count, RANGE_SEGMENTS)
+        ]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def encrypt_parallel(
+    src: Path,
+    dst: Path,
+    key: bytes,
+    header: Header,
+    threads: int,
+    timer: PhaseTimer | None = None,
+) -> Iterator[int]:
+    """Encrypt regular file src into a new container dst using several threads.
+    Yields number of plaintext bytes processed."""
+    size = src.stat().st_size
+    count = segment_count(size, header.segment_size)
+    if count > MAX_SEGMENTS:
+        raise OverflowError("Too many segments")
+    with open(dst, "wb") as f_out:
+        f_out.write(header.pack())
+        f_out.truncate(encrypted_size(size, header.segment_size))
+    yield from process_ranges(
+        encrypt_range, src, dst, key, header, count, threads, timer
+    )
+
+
+def decrypt_parallel(
+    src: Path,
+    dst: Path,
+    key: bytes,
+    header: Header,
+    threads: int,
+    timer: PhaseTimer | None = None,
+) -> Iterator[int]:
+    """Decrypt container src into dst using several threads.
+    Yields number of encrypted bytes processed."""
+    size, count = decrypted_size(src.stat().st_size, header.segment_size)
+    with open(dst, "wb") as f_out:
+        f_out.truncate(size)
+    yield from process_ranges(
+        decrypt_range, src, dst, key, header, count, threads, timer
+    )
+
+
+def verify_parallel(
+    src: Path,
+    key: bytes,
+    header: Header,
+    threads: int,
+    timer: PhaseTimer | None = None,
+) -> Iterator[int]:
+    """Authenticate container src using several threads.
+    Yields number of encrypted bytes processed."""
+    _, count = decrypted_size(src.stat().st_size, header.segment_size)
+    yield from process_ranges(
+        verify_range, src, None, key, header, count, threads, timer
+    )
+
+
+def can_map(path: Path) -> bool:
+    """Whether path is a non-empty regular file, which can be memory mapped.
+    Pipes, devices and other special files have to be streamed."""
+    try:
+        info = path.stat()
+    except OSError:
+        return False
+    return stat.S_ISREG(info.st_mode) and info.st_size > 0
+
+
+def allocate(f_out: BinaryIO, size: int) -> None:
+    """Extend f_out to size, reserving disk space where the platform allows,
+    so running out of space fails here instead of in a page fault."""
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(f_out.fileno(), 0, size)
+            return
+        except OSError:  # Not supported by the file system
+            pass
+    f_out.truncate(size)
+
+
+@contextmanager
+def mapped(file: BinaryIO, writable: bool) -> Iterator[memoryview]:
+    """Memory map the whole file. Views of the map must be gone on exit."""
+    access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+    with mmap.mmap(file.fileno(), 0, access=access) as memory_map:
+        if not writable and hasattr(memory_map, "madvise"):
+            memory_map.madvise(mmap.MADV_SEQUENTIAL)  # Read ahead aggressively
+        view = memoryview(memory_map)
+        try:
+            yield view
+        except BaseException as err:
+            # Finished frames of the traceback still hold views of the map
+            traceback.clear_frames(err.__traceback__)
+            raise
+        finally:
+            view.release()
+
+
+def unmap_range(view: memoryview, start: int, end: int) -> None:
+    """Drop pages of the mapped file within [start, end) from this process, which
+    keeps its resident memory small. Their data stays in the page cache."""
+    if not hasattr(mmap, "MADV_DONTNEED"):
+        return
+    start = -(-start // mmap.PAGESIZE) * mmap.PAGESIZE
+    end = end // mmap.PAGESIZE * mmap.PAGESIZE
+    if end > start:
+        view.obj.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+
+def map_ranges(
+    process_range: Callable[[int, int], int], count: int, threads: int
+) -> Iterator[int]:
+    """Call process_range(first, stop) for ranges of MAP_SEGMENTS segments,
+    concurrently if threads > 1. Yields what each call returns."""
+    ranges = [
+        (first, min(first + MAP_SEGMENTS, count))
+        for first in range(0, count, MAP_SEGMENTS)
+    ]
+    if threads < 2:
+        for first, stop in ranges:
+            yield process_range(first, stop)
+        return
+    executor = ThreadPoolExecutor(max_workers=threads)
+    try:
+        futures = [executor.submit(process_range, *item) for item in ranges]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def encrypt_mapped(
+    src: Path,
+    dst: Path,
+    key: bytes,
+    header: Header,
+    threads: int = 1,
+    timer: PhaseTimer | None = None,
+) -> Iterator[int]:
+    """Encrypt non-empty regular file src (see can_map) into a new container dst
+    through memory maps. The cipher reads the mapped input and writes straight into
+    the mapped output, so no data is copied through Python buffers and there are no
+    read or write calls. Page faults are therefore accounted to the cipher phase.
+    Segment ranges are encrypted by threads. Yields number of plaintext bytes
+    processed."""
+    timer = timer or PhaseTimer()
+    header_bytes = header.pack()
+    segment_size = header.segment_size
+    block_size = segment_size + TAG_SIZE
+    with open(src, "rb") as f_in, open(dst, "w+b") as f_out:
+        size = os.fstat(f_in.fileno()).st_size
+        count = segment_count(size, segment_size)
+        if count > MAX_SEGMENTS:
+            raise OverflowError("Too many segments")
+        with timer.phase("write"):
+            allocate(f_out, encrypted_size(size, segment_size))
+        with mapped(f_in, False) as source, mapped(f_out, True) as target:
+            target[:HEADER_SIZE] = header_bytes
+
+            def encrypt(first: int, stop: int) -> int:
+                start, end = first * segment_size, min(stop * segment_size, size)
+                offset = HEADER_SIZE + first * block_size
+                with timer.phase("cipher", end - start):
+                    written, _ = encrypt_segments(
+                        source[start:end],
+                        target[offset:],
+                        key,
+                        header,
+                        header_bytes,
+                        first,
+                        stop == count,
+                    )
+                unmap_range(source, start, end)
+                unmap_range(target, offset, offset + written)
+                return end - start
+
+            yield from map_ranges(encrypt, count, threads)
+
+
+def decrypt_mapped(
+    src: Path,
+    dst: Path,
+    key: bytes,
+    header: Header,
+    threads: int = 1,
+    timer: PhaseTimer | None = None,
+) -> Iterator[int]:
+    """Decrypt container src into dst through memory maps, see encrypt_mapped.
+    Segments are decrypted into a buffer of every thread and only copied into the
+    mapped dst once verified, so plaintext of a segment that fails authentication
+    never reaches dst. Yields number of encrypted bytes processed."""
+    timer = timer or PhaseTimer()
+    header_bytes = header.pack()
+    segment_size = header.segment_size
+    block_size = segment_size + TAG_SIZE
+    with open(src, "rb") as f_in, open(dst, "w+b") as f_out:
+        encrypted = os.fstat(f_in.fileno()).st_size
+        size, count = decrypted_size(encrypted, segment_size)
+        if not size:  # Only the empty last segment, nothing to map
+            f_in.seek(HEADER_SIZE)
+            with timer.phase("cipher"):
+                verify_segments(
+                    memoryview(f_in.read()), key, header, header_bytes, 0, True
+                )
+            yield encrypted - HEADER_SIZE
+            return
+        with timer.phase("write"):
+            allocate(f_out, size)
+        buffers = threading.local()
+        with mapped(f_in, False) as source, mapped(f_out, True) as target:
+
+            def decrypt(first: int, stop: int) -> int:
+                start = HEADER_SIZE + first * block_size
+                end = min(HEADER_SIZE + stop * block_size, encrypted)
+                offset = first * segment_size
+                if not hasattr(buffers, "output"):
+                    buffers.output = memoryview(bytearray(MAP_SEGMENTS * segment_size))
+                with timer.phase("cipher", end - start):
+                    written, _ = decrypt_segments(
+                        source[start:end],
+                        buffers.output,
+                        key,
+                        header,
+                        header_bytes,
+                        first,
+                        stop == count,
+                    )
+                with timer.phase("write", written):
+                    target[offset : offset + written] = buffers.output[:written]
+                unmap_range(source, start, end)
+                unmap_range(target, offset, offset + written)
+                return end - start
+
+            yield from map_ranges(decrypt, count, threads)
@@ -1,52 +1,255 @@
+import hashlib
+import hmac
 import os
+import time
 import zipfile
+from collections import OrderedDict
+from contextlib import closing, contextmanager
 from pathlib import Path
-from typing import Iterator, Literal
+from typing import BinaryIO, Iterable, Iterator, Literal
 
 from Crypto.Cipher import ChaCha20_Poly1305
 from Crypto.Protocol.KDF import scrypt
 
-from helpers import File, path_size
+from container import (
+    HEADER_SIZE,
+    MAGIC,
+    RANGE_SEGMENTS,
+    SEGMENT_SIZE,
+    VERSION,
+    Header,
+    SegmentReader,
+    SegmentWriter,
+    aead_mac,
+    aead_verify,
+    can_map,
+    decrypt_mapped,
+    decrypt_parallel,
+    decrypt_pipelined,
+    decrypt_stream,
+    decrypted_size,
+    encrypt_mapped,
+    encrypt_parallel,
+    encrypt_pipelined,
+    encrypt_stream,
+    read_file_header,
+    read_header,
+    read_into,
+    verify_parallel,
+    verify_stream,
+)
+from compress import (
+    ALGORITHMS,
+    CompressingWriter,
+    compression_name,
+    decrypt_compressed,
+    encrypt_compressed,
+    is_compressible,
+)
+from helpers import File
+from timing import EventCallback, PhaseTimer, file_event, timed_iter
 
 CHUNK_SIZE = 1024 * 1024  # 1 MiB
 
+# Chunk size auto-tuning (see auto_chunk_size)
+MIN_CHUNK_SIZE = SEGMENT_SIZE
+MAX_CHUNK_SIZE = 64 * SEGMENT_SIZE
+PROBE_SIZE = 4 * 1024 * 1024  # 4 MiB
+TARGET_CHUNK_TIME = 0.05  # Seconds it should take to read a chunk
+MIN_PROGRESS_STEPS = 64  # Chunks per file, to keep progress smooth
+
+# Files larger than this are split into segment ranges processed by several threads
+PARALLEL_THRESHOLD = RANGE_SEGMENTS * SEGMENT_SIZE
+
+# Smaller files are streamed by a single thread, as starting the reader and writer
+# threads of a pipeline or mapping the files isn't worth it for a few chunks.
+# Larger regular files on fast storage are memory mapped (see use_mapped), other
+# ones go through a pipeline.
+PIPELINE_THRESHOLD = 4 * SEGMENT_SIZE
+
+# Read speed (bytes/s) below which storage is streamed instead of memory mapped.
+# Spinning disks and network mounts are slower than this.
+MAP_MIN_READ_SPEED = 400 * 1024 * 1024
+
+# scrypt parameters used for password based key derivation
+SCRYPT_N = 2**20
+SCRYPT_R = 8
+SCRYPT_P = 1
+SCRYPT_MEMORY = 128 * SCRYPT_R * SCRYPT_N  # 1 GiB of RAM per derivation
+
+# Salt, key nonce, key tag, encrypted key, nonce and tag of the original format
+V1_HEADER_SIZE = 104
+
+
+class NotEncryptedError(ValueError):
+    pass
+
 
 class Key:
     """Create new Key object which contains the plaintext key and it's encrypted version.
     Also sets it's tag and nonce.
     """
 
-    def __init__(self, password: str) -> None:
+    def __init__(
+        self, password: str, derived_key: tuple[bytes, bytes] | None = None
+    ) -> None:
         # Key that will be used to encrypt file data
         self.data_key = os.urandom(32)
 
-        # Key that will be used to encrypt the data key
-        key, self.salt = self.key_derive(password)
+        # Key that will be used to encrypt the data key.
+        # A (key, salt) pair derived beforehand can be shared by a batch of files,
+        # each data key is then encrypted with its own random nonce.
+        key, self.salt = derived_key or self.key_derive(password)
 
         cipher = ChaCha20_Poly1305.new(key=key)
         self.data_key_encrypted = cipher.encrypt(self.data_key)
         self.data_key_tag = cipher.digest()
         self.data_key_nonce = cipher.nonce
 
+    def header(self, flags: int = 0) -> Header:
+        """Build container header for a new file encrypted with this key."""
+        return Header(
+            salt=self.salt,
+            key_nonce=self.data_key_nonce,
+            key_tag=self.data_key_tag,
+            key_encrypted=self.data_key_encrypted,
+            nonce_prefix=os.urandom(7),
+            scrypt_log2_n=SCRYPT_N.bit_length() - 1,
+            scrypt_r=SCRYPT_R,
+            scrypt_p=SCRYPT_P,
+            flags=flags,
+        )
+
     @staticmethod
-    def key_derive(password: str, salt: bytes | None = None) -> tuple[bytes, bytes]:
+    def key_derive(
+        password: str,
+        salt: bytes | None = None,
+        n: int = SCRYPT_N,
+        r: int = SCRYPT_R,
+        p: int = SCRYPT_P,
+    ) -> tuple[bytes, bytes]:
         if not salt:
             salt = os.urandom(16)  # 16 cryptographically secure random bytes
-        key = scrypt(password, str(salt), key_len=32, N=2**20, r=8, p=1)
+        key = scrypt(password, str(salt), key_len=32, N=n, r=r, p=p)
         if not isinstance(key, bytes):
             raise TypeError
         return key, salt
 
 
+class KeyCache:
+    """In-memory LRU cache of password derived keys for a decryption session.
+
+    Entries are keyed on salt, scrypt parameters and a keyed digest of the password.
+    Keys are zeroized when evicted and when the cache is cleared. This is best effort,
+    as immutable copies made by scrypt itself can't be wiped from Python."""
+
+    def __init__(self, max_size: int = 64) -> None:
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.derive_time = 0.0  # Seconds spent in scrypt on misses
+        self._secret = os.urandom(32)
+        self._keys: OrderedDict[tuple, bytearray] = OrderedDict()
+
+    def __enter__(self) -> "KeyCache":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.clear()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def _entry(self, password: str, salt: bytes, n: int, r: int, p: int) -> tuple:
+        digest = hmac.new(self._secret, password.encode(), hashlib.sha256).digest()
+        return salt, n, r, p, digest
+
+    def get(
+        self,
+        password: str,
+        salt: bytes,
+        n: int = SCRYPT_N,
+        r: int = SCRYPT_R,
+        p: int = SCRYPT_P,
+    ) -> bytearray | None:
+        entry = self._entry(password, salt, n, r, p)
+        if (key := self._keys.get(entry)) is None:
+            self.misses += 1
+            return None
+        self._keys.move_to_end(entry)
+        self.hits += 1
+        return key
+
+    def put(
+        self,
+        password: str,
+        salt: bytes,
+        key: bytes,
+        n: int = SCRYPT_N,
+        r: int = SCRYPT_R,
+        p: int = SCRYPT_P,
+    ) -> bytearray:
+        entry = self._entry(password, salt, n, r, p)
+        if entry in self._keys:
+            self._zeroize(self._keys.pop(entry))
+        self._keys[entry] = stored_key = bytearray(key)
+        while len(self._keys) > self.max_size:
+            _, evicted_key = self._keys.popitem(last=False)
+            self._zeroize(evicted_key)
+        return stored_key
+
+    def derive(
+        self,
+        password: str,
+        salt: bytes,
+        n: int = SCRYPT_N,
+        r: int = SCRYPT_R,
+        p: int = SCRYPT_P,
+    ) -> bytearray:
+        """Return cached key for given password and salt, derive it on a miss."""
+        if (key := self.get(password, salt, n, r, p)) is not None:
+            return key
+        start = time.perf_counter()
+        derived_key, _ = Key.key_derive(password, salt, n, r, p)
+        self.derive_time += time.perf_counter() - start
+        return self.put(password, salt, derived_key, n, r, p)
+
+    def clear(self) -> None:
+        for key in self._keys.values():
+            self._zeroize(key)
+        self._keys.clear()
+
+    def stats(self) -> dict[str, float]:
+        """Hit/miss counters and the estimated scrypt time saved by hits."""
+        average = self.derive_time / self.misses if self.misses else 0.0
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._keys),
+            "saved_seconds": self.hits * average,
+        }
+
+    @staticmethod
+    def _zeroize(key: bytearray) -> None:
+        key[:] = bytes(len(key))
+
+
 def decrypt_key(
     encrypted_key: bytes,
     salt: bytes,
     nonce: bytes,
     tag: bytes,
     password: str,
+    key_cache: KeyCache | None = None,
+    n: int = SCRYPT_N,
+    r: int = SCRYPT_R,
+    p: int = SCRYPT_P,
 ) -> bytes | Literal[False]:
     """Try to decrypt and verify an encrypted key. Returns False if failed."""
-    key, _ = Key.key_derive(password, salt)
+    if key_cache is not None:
+        key = key_cache.derive(password, salt, n, r, p)
+    else:
+        key, _ = Key.key_derive(password, salt, n, r, p)
     cipher = ChaCha20_Poly1305.new(key=key, nonce=nonce)
     try:
         decrypted_key = cipher.decrypt_and_verify(encrypted_key, tag)
@@ -56,42 +259,103 @@ def decrypt_key(
     return decrypted_key
 
 
-def encrypt_files(files: dict[File, Path], password: str) -> Iterator:
+def encrypt_files(
+    files: dict[File, Path],
+    password: str,
+    derived_key: tuple[bytes, bytes] | None = None,
+    threads: int | None = None,
+    chunk_size: int | None = None,
+    on_event: EventCallback | None = None,
+    compression: str | None = None,
+    compression_level: int | None = None,
+) -> Iterator:
+    """Encrypt files. If derived_key (see Key.key_derive) is given, it is used
+    for every file instead of deriving a new key per file (batch mode).
+    Large files are encrypted by several threads (all CPUs by default).
+    Data is read in chunks of chunk_size, chosen per file if not given. Large files
+    on fast storage are memory mapped instead, unless chunk_size is given.
+    on_event receives file_start and file_end events (see timing.py).
+    With compression ("zlib" or "zstd"), files and folders are compressed before
+    encryption unless a sample of them doesn't compress (see compress.py)."""
+    threads = threads or os.cpu_count() or 1
+    algorithm = ALGORITHMS[compression] if compression else 0
     files_processed: int = 0
     for file_in, file_out in files.items():
-        header: bytes = b""
-        archive_path: Path | None = None
         perfile_progress: int = 0
         display_name: str = file_in.path.name
+        file_tmp = Path(f"{file_out}.tmp")
+        timer = PhaseTimer()
+        status = "ok"
+        error = ""
+        start = time.perf_counter()
+        if on_event:
+            on_event(file_event("file_start", "encrypt", file_in.path, file_in.size))
         try:
             yield files_processed + perfile_progress, display_name
-            key = Key(password)
-            cipher = ChaCha20_Poly1305.new(key=key.data_key)
-            tag_placeholder = os.urandom(16)
-
-            # Build header
-            for i in (
-                key.salt,  # 16 bytes
-                key.data_key_nonce,  # 12 bytes
-                key.data_key_tag,  # 16 bytes
-                key.data_key_encrypted,  # 32 bytes
-                cipher.nonce,  # 12 bytes
-                tag_placeholder,  # 16 bytes
-            ):
-                header += i  # = 104 bytes
+            with timer.phase("kdf"):
+                key = Key(password, derived_key)
+            file_chunk_size = chunk_size or auto_chunk_size(file_in.path, file_in.size)
+            file_algorithm = 0
+            if algorithm:
+                with timer.phase("compress"):
+                    if is_compressible(file_in.path):
+                        file_algorithm = algorithm
 
             if file_in.path.is_dir():
-                archive_path = file_out.with_suffix(".tmp")
-                zip_folder(file_in.path, archive_path)
-                file_in = File(archive_path, path_size(archive_path))
-
-            file_out = Path(f"{file_out}.tmp")
-            with open(file_in.path, "rb") as f_in, open(file_out, "wb") as f_out:
-                f_out.write(header)
-                while chunk := f_in.read(CHUNK_SIZE):  # Walrus
-                    encrypted_chunk = cipher.encrypt(chunk)
-                    f_out.write(encrypted_chunk)
-                    perfile_progress += len(chunk)
+                encryptor = encrypt_folder(
+                    file_in.path,
+                    file_tmp,
+                    key.data_key,
+                    key.header(file_algorithm),
+                    file_chunk_size,
+                    timer,
+                    compression_level,
+                    threads,
+                )
+            elif file_algorithm:
+                encryptor = encrypt_compressed(
+                    file_in.path,
+                    file_tmp,
+                    key.data_key,
+                    key.header(file_algorithm),
+                    file_chunk_size,
+                    compression_level,
+                    threads,
+                    timer,
+                )
+            elif use_mapped(file_in.path, file_in.size, chunk_size):
+                encryptor = encrypt_mapped(
+                    file_in.path,
+                    file_tmp,
+                    key.data_key,
+                    key.header(),
+                    threads if file_in.size > PARALLEL_THRESHOLD else 1,
+                    timer,
+                )
+            elif threads > 1 and file_in.size > PARALLEL_THRESHOLD:
+                encryptor = encrypt_parallel(
+                    file_in.path, file_tmp, key.data_key, key.header(), threads, timer
+                )
+            else:
+                engine = (
+                    encrypt_pipelined
+                    if file_in.size > PIPELINE_THRESHOLD
+                    else encrypt_stream
+                )
+                encryptor = engine(
+                    file_in.path,
+                    file_tmp,
+                    key.data_key,
+                    key.header(),
+                    file_chunk_size,
+                    timer,
+                )
+
+            # The engine is closed before its .tmp output is deleted, as Windows
+            # can't delete files that are still open or mapped
+            with closing(encryptor):
+                for processed in encryptor:
+                    perfile_progress += processed
                     try:
                         yield (
                             files_processed + perfile_progress / file_in.size,
@@ -99,93 +363,589 @@ def encrypt_files(files: dict[File, Path], password: str) -> Iterator:
                         )
                     except ZeroDivisionError:  # Empty file or dir
                         pass
+            with timer.phase("rename"):
+                file_tmp.replace(file_out)  # Remove .tmp suffix
 
-                # Get MAC tag of all the data passed through the encryptor
-                tag = cipher.digest()
-                # Place file handle at the begining of the tag placeholder
-                f_out.seek(88)
-                f_out.write(tag)  # Overwrite placeholder with the actual tag
-            file_out.replace(file_out.with_suffix(""))  # Remove .tmp suffix
+        # Processing was cancelled by the consumer
+        except GeneratorExit:
+            status = "cancelled"
+            file_tmp.unlink(missing_ok=True)
+            raise
 
         # Something "unexpected" happened
         except Exception as err:
+            status = "error"
+            error = repr(err)
             # Delete tmp file if it exists
-            if file_out.exists():
-                file_out.unlink()
+            file_tmp.unlink(missing_ok=True)
             yield err, display_name
 
-        # Delete tmp zip archive in any case
         finally:
-            if archive_path:
-                archive_path.unlink()
+            if on_event:
+                on_event(
+                    file_event(
+                        "file_end",
+                        "encrypt",
+                        file_in.path,
+                        file_in.size,
+                        status=status,
+                        seconds=round(time.perf_counter() - start, 6),
+                        **timer.report(),
+                        **({"error": error} if error else {}),
+                    )
+                )
 
         files_processed += 1
 
 
-def decrypt_files(files: dict[File, Path], password: str) -> Iterator:
+def decrypt_files(
+    files: dict[File, Path],
+    password: str,
+    key_cache: KeyCache | None = None,
+    threads: int | None = None,
+    chunk_size: int | None = None,
+    on_event: EventCallback | None = None,
+) -> Iterator:
+    """Decrypt files. Files that share a salt (encrypted in batch mode)
+    only cost a single key derivation. If key_cache is not given, a new one is
+    used for this call and cleared afterwards.
+    Large files are decrypted by several threads (all CPUs by default).
+    Data is read in chunks of chunk_size, chosen per file if not given. Large files
+    on fast storage are memory mapped instead, unless chunk_size is given.
+    on_event receives file_start and file_end events (see timing.py)."""
+    if key_cache is None:
+        with KeyCache() as session_cache:
+            yield from decrypt_files(
+                files, password, session_cache, threads, chunk_size, on_event
+            )
+        return
+
+    threads = threads or os.cpu_count() or 1
+
     files_processed: int = 0
     for file_in, file_out in files.items():
         perfile_progress: int = 0
         display_name: str = file_in.path.name
+        file_tmp = Path(f"{file_out}.tmp")
+        timer = PhaseTimer()
+        status = "ok"
+        error = ""
+        start = time.perf_counter()
+        if on_event:
+            on_event(file_event("file_start", "decrypt", file_in.path, file_in.size))
         try:
             yield files_processed + perfile_progress, display_name
-            file_out = Path(f"{file_out}.tmp")
-
-            with open(file_in.path, "rb") as f_in, open(file_out, "wb") as f_out:
-                header = {
-                    "key_salt": f_in.read(16),
-                    "key_nonce": f_in.read(12),
-                    "key_tag": f_in.read(16),
-                    "key_encrypted": f_in.read(32),
-                    "nonce": f_in.read(12),
-                    "tag": f_in.read(16),
-                }
-                if not (
-                    key := decrypt_key(
-                        header["key_encrypted"],
-                        header["key_salt"],
-                        header["key_nonce"],
-                        header["key_tag"],
-                        password,
+            check_encrypted(file_in.path)  # Before spending time on key derivation
+            file_chunk_size = chunk_size or auto_chunk_size(file_in.path, file_in.size)
+
+            if not (header := read_file_header(file_in.path)):
+                decryptor = decrypt_v1(
+                    file_in.path, file_tmp, password, key_cache, file_chunk_size, timer
+                )
+            else:
+                with timer.phase("kdf"):
+                    key = decrypt_data_key(header, password, key_cache)
+                if header.compression:
+                    decryptor = decrypt_compressed(
+                        file_in.path, file_tmp, key, header, file_chunk_size, timer
+                    )
+                elif use_mapped(file_in.path, file_in.size, chunk_size):
+                    decryptor = decrypt_mapped(
+                        file_in.path,
+                        file_tmp,
+                        key,
+                        header,
+                        threads if file_in.size > PARALLEL_THRESHOLD else 1,
+                        timer,
+                    )
+                elif threads > 1 and file_in.size > PARALLEL_THRESHOLD:
+                    decryptor = decrypt_parallel(
+                        file_in.path, file_tmp, key, header, threads, timer
+                    )
+                else:
+                    engine = (
+                        decrypt_pipelined
+                        if file_in.size > PIPELINE_THRESHOLD
+                        else decrypt_stream
                     )
-                ):
-                    raise KeyError
-
-                cipher = ChaCha20_Poly1305.new(key=key, nonce=header["nonce"])
-                while chunk := f_in.read(CHUNK_SIZE):  # Walrus
-                    decrypted_chunk = cipher.decrypt(chunk)
-                    f_out.write(decrypted_chunk)
-                    perfile_progress += len(chunk)
+                    decryptor = engine(
+                        file_in.path, file_tmp, key, header, file_chunk_size, timer
+                    )
+
+            # Closed before its .tmp output is deleted, see encrypt_files
+            with closing(decryptor):
+                for processed in decryptor:
+                    perfile_progress += processed
                     yield (
                         files_processed + perfile_progress / file_in.size,
                         display_name,
                     )
 
-                cipher.verify(header["tag"])
+            with timer.phase("rename"):
+                file_tmp.replace(file_out)  # Remove .tmp suffix
 
-            file_out.replace(file_out.with_suffix(""))  # Remove .tmp suffix
+        # Processing was cancelled by the consumer
+        except GeneratorExit:
+            status = "cancelled"
+            file_tmp.unlink(missing_ok=True)
+            raise
 
         # Decryption failed due to incorrect password or corrupt data
         except (ValueError, KeyError):
+            status = "failed"
             # Delete tmp file if it exists
-            if file_out.exists():
-                file_out.unlink()
+            file_tmp.unlink(missing_ok=True)
             yield False, file_in
 
         # Something "unexpected" happened
         except Exception as err:
+            status = "error"
+            error = repr(err)
             # Delete tmp file if it exists
-            if file_out.exists():
-                file_out.unlink()
+            file_tmp.unlink(missing_ok=True)
             yield err, display_name
 
+        finally:
+            if on_event:
+                on_event(
+                    file_event(
+                        "file_end",
+                        "decrypt",
+                        file_in.path,
+                        file_in.size,
+                        status=status,
+                        seconds=round(time.perf_counter() - start, 6),
+                        **timer.report(),
+                        **({"error": error} if error else {}),
+                    )
+                )
+
         files_processed += 1
 
 
-def zip_folder(dir_path: Path, archive_path: Path) -> None:
-    """Zip folder into archive (archive_path) without compression."""
-    with zipfile.ZipFile(archive_path, "w", zipfile.ZIP_STORED) as archive:
+def verify_files(
+    files: Iterable[File],
+    password: str,
+    key_cache: KeyCache | None = None,
+    threads: int | None = None,
+    chunk_size: int | None = None,
+    on_event: EventCallback | None = None,
+) -> Iterator:
+    """Check that files are intact and encrypted with the password. Only the
+    Poly1305 tags are computed, nothing is decrypted or written to disk. Files may be
+    given as a dict (like for decrypt_files), output paths are then ignored.
+
+    Yields the same results as decrypt_files. The file_end events tell failures apart:
+    status is "not_encrypted", "corrupt" or "wrong_password" (which a corrupt key
+    in the header looks like as well)."""
+    if key_cache is None:
+        with KeyCache() as session_cache:
+            yield from verify_files(
+                files, password, session_cache, threads, chunk_size, on_event
+            )
+        return
+
+    threads = threads or os.cpu_count() or 1
+
+    files_processed: int = 0
+    for file_in in files:
+        perfile_progress: int = 0
+        display_name: str = file_in.path.name
+        timer = PhaseTimer()
+        status = "ok"
+        error = ""
+        start = time.perf_counter()
+        if on_event:
+            on_event(file_event("file_start", "verify", file_in.path, file_in.size))
+        try:
+            yield files_processed + perfile_progress, display_name
+            check_encrypted(file_in.path)  # Before spending time on key derivation
+            file_chunk_size = chunk_size or auto_chunk_size(file_in.path, file_in.size)
+
+            if not (header := read_file_header(file_in.path)):
+                verifier = verify_v1(
+                    file_in.path, password, key_cache, file_chunk_size, timer
+                )
+            else:
+                with timer.phase("kdf"):
+                    key = decrypt_data_key(header, password, key_cache)
+                if threads > 1 and file_in.size > PARALLEL_THRESHOLD:
+                    verifier = verify_parallel(
+                        file_in.path, key, header, threads, timer
+                    )
+                else:
+                    verifier = verify_stream(
+                        file_in.path, key, header, file_chunk_size, timer
+                    )
+
+            for processed in verifier:
+                perfile_progress += processed
+                yield (
+                    files_processed + perfile_progress / file_in.size,
+                    display_name,
+                )
+
+        # Processing was cancelled by the consumer
+        except GeneratorExit:
+            status = "cancelled"
+            raise
+
+        except NotEncryptedError:
+            status = "not_encrypted"
+            yield False, file_in
+
+        # Data key couldn't be decrypted
+        except KeyError:
+            status = "wrong_password"
+            yield False, file_in
+
+        # Data doesn't match its tags
+        except ValueError:
+            status = "corrupt"
+            yield False, file_in
+
+        # Something "unexpected" happened
+        except Exception as err:
+            status = "error"
+            error = repr(err)
+            yield err, display_name
+
+        finally:
+            if on_event:
+                on_event(
+                    file_event(
+                        "file_end",
+                        "verify",
+                        file_in.path,
+                        file_in.size,
+                        status=status,
+                        seconds=round(time.perf_counter() - start, 6),
+                        **timer.report(),
+                        **({"error": error} if error else {}),
+                    )
+                )
+
+        files_processed += 1
+
+
+def sniff_file(path: Path) -> int | None:
+    """Tell format version of an encrypted file from its header and size only,
+    without key derivation. Returns None if the file can't be one. Files of the
+    original format (1) have no identifier, any file holding its header passes."""
+    try:
+        size = path.stat().st_size
+        with open(path, "rb") as file:
+            data = file.read(HEADER_SIZE)
+        if header := Header.unpack(data):
+            decrypted_size(size, header.segment_size)  # Raises if truncated
+            return VERSION
+    except (OSError, ValueError):
+        return None
+    if data.startswith(MAGIC):
+        return None  # Unsupported version
+    return 1 if size >= V1_HEADER_SIZE else None
+
+
+def check_encrypted(path: Path) -> None:
+    """Raise NotEncryptedError if path can't be an encrypted file (see sniff_file)."""
+    if not sniff_file(path):
+        raise NotEncryptedError(f"{path.name} is not an encrypted file")
+
+
+def inspect_file(path: Path) -> dict:
+    """Describe an encrypted file using only its header. Nothing is decrypted.
+    Raises NotEncryptedError if it isn't one."""
+    check_encrypted(path)
+    size = path.stat().st_size
+    if not (header := read_file_header(path)):
+        return {"version": 1, "size": size, "plaintext_size": size - V1_HEADER_SIZE}
+
+    plaintext_size, segments = decrypted_size(size, header.segment_size)
+    return {
+        "version": 2,
+        "size": size,
+        "plaintext_size": plaintext_size,
+        "segment_size": header.segment_size,
+        "segments": segments,
+        "scrypt": {"n": header.scrypt_n, "r": header.scrypt_r, "p": header.scrypt_p},
+        "flags": header.flags,
+        "compression": compression_name(header.compression),
+    }
+
+
+def decrypt_v1(
+    src: Path,
+    dst: Path,
+    password: str,
+    key_cache: KeyCache,
+    chunk_size: int = CHUNK_SIZE,
+    timer: PhaseTimer | None = None,
+) -> Iterator[int]:
+    """Decrypt the original single stream format (104 bytes header).
+    The whole stream is only verified after the last chunk is written."""
+    timer = timer or PhaseTimer()
+    with open(src, "rb") as f_in, open(dst, "wb") as f_out:
+        header = read_v1_header(f_in)
+        with timer.phase("kdf"):
+            key = decrypt_v1_key(header, password, key_cache)
+
+        cipher = ChaCha20_Poly1305.new(key=key, nonce=header["nonce"])
+        buffer = memoryview(bytearray(chunk_size))
+        output = memoryview(bytearray(chunk_size))
+        while True:
+            with timer.phase("read"):
+                length = read_into(f_in, buffer)
+            if not length:
+                break
+            timer.add("read", 0, length)
+            with timer.phase("cipher", length):
+                cipher.decrypt(buffer[:length], output=output[:length])
+            with timer.phase("write", length):
+                f_out.write(output[:length])
+            yield length
+
+        with timer.phase("cipher"):
+            cipher.verify(header["tag"])
+
+
+def read_v1_header(f_in: BinaryIO) -> dict[str, bytes]:
+    """Read header of the original single stream format (104 bytes)."""
+    return {
+        "key_salt": f_in.read(16),
+        "key_nonce": f_in.read(12),
+        "key_tag": f_in.read(16),
+        "key_encrypted": f_in.read(32),
+        "nonce": f_in.read(12),
+        "tag": f_in.read(16),
+    }
+
+
+def decrypt_v1_key(
+    header: dict[str, bytes], password: str, key_cache: KeyCache | None = None
+) -> bytes:
+    """Decrypt data key of the original format. Raises KeyError if failed."""
+    if not (
+        key := decrypt_key(
+            header["key_encrypted"],
+            header["key_salt"],
+            header["key_nonce"],
+            header["key_tag"],
+            password,
+            key_cache,
+        )
+    ):
+        raise KeyError
+    return key
+
+
+def verify_v1(
+    src: Path,
+    password: str,
+    key_cache: KeyCache,
+    chunk_size: int = CHUNK_SIZE,
+    timer: PhaseTimer | None = None,
+) -> Iterator[int]:
+    """Authenticate a file of the original single stream format without decrypting it.
+    Raises KeyError on incorrect password, ValueError on corrupt data."""
+    timer = timer or PhaseTimer()
+    with open(src, "rb") as f_in:
+        header = read_v1_header(f_in)
+        with timer.phase("kdf"):
+            key = decrypt_v1_key(header, password, key_cache)
+
+        mac = aead_mac(key, header["nonce"], b"")
+        buffer = memoryview(bytearray(chunk_size))
+        total = 0
+        while True:
+            with timer.phase("read"):
+                length = read_into(f_in, buffer)
+            if not length:
+                break
+            timer.add("read", 0, length)
+            with timer.phase("cipher", length):
+                mac.update(buffer[:length])
+            total += length
+            yield length
+
+        with timer.phase("cipher"):
+            aead_verify(mac, 0, total, header["tag"])
+
+
+def decrypt_data_key(
+    header: Header, password: str, key_cache: KeyCache | None = None
+) -> bytes:
+    """Decrypt data key of a segmented container. Raises KeyError if failed."""
+    if not (
+        key := decrypt_key(
+            header.key_encrypted,
+            header.salt,
+            header.key_nonce,
+            header.key_tag,
+            password,
+            key_cache,
+            header.scrypt_n,
+            header.scrypt_r,
+            header.scrypt_p,
+        )
+    ):
+        raise KeyError
+    return key
+
+
+# Read speed of storage devices measured by probe_read_speed, by device id
+read_speeds: dict[int, float] = {}
+
+
+def probe_read_speed(path: Path) -> float | None:
+    """Measure read speed (bytes/s) of the device holding the file by reading up to
+    PROBE_SIZE from the middle of it. Every device is only probed once."""
+    stat = path.stat()
+    if stat.st_dev in read_speeds:
+        return read_speeds[stat.st_dev]
+    if stat.st_size < PROBE_SIZE:
+        return None  # Too small for a meaningful result
+
+    buffer = memoryview(bytearray(PROBE_SIZE))
+    with open(path, "rb") as file:
+        file.seek((stat.st_size - PROBE_SIZE) // 2)
+        start = time.perf_counter()
+        read = read_into(file, buffer)
+        elapsed = time.perf_counter() - start
+
+    read_speeds[stat.st_dev] = read / max(elapsed, 1e-6)
+    return read_speeds[stat.st_dev]
+
+
+def auto_chunk_size(path: Path, size: int) -> int:
+    """Pick chunk size for a file: large enough to keep a fast device busy
+    (a chunk should take about TARGET_CHUNK_TIME to read), small enough to report
+    progress at least MIN_PROGRESS_STEPS times. Rounded down to a power of two."""
+    try:
+        speed = probe_read_speed(path) if path.is_file() else None
+    except OSError:
+        speed = None
+    if not speed:
+        return CHUNK_SIZE
+
+    chunk_size = min(speed * TARGET_CHUNK_TIME, size / MIN_PROGRESS_STEPS)
+    chunk_size = max(MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, int(chunk_size)))
+    return 1 << (chunk_size.bit_length() - 1)
+
+
+def use_mapped(path: Path, size: int, chunk_size: int | None) -> bool:
+    """Whether to process a file through memory maps: regular files larger than
+    PIPELINE_THRESHOLD on storage at least MAP_MIN_READ_SPEED fast. Page faults
+    of a map read a few pages at a time, so slower devices are kept busy by the
+    pipeline or the threads of the parallel engines instead. A chunk size given
+    by the user is honoured by streaming as well."""
+    if chunk_size or size <= PIPELINE_THRESHOLD or not can_map(path):
+        return False
+    try:
+        speed = probe_read_speed(path)
+    except OSError:
+        return False
+    return speed is not None and speed >= MAP_MIN_READ_SPEED
+
+
+def read_key_params(path: Path) -> tuple[bytes, int, int, int]:
+    """Read key salt and scrypt parameters (n, r, p) from the header of an encrypted
+    file. Files of the original format always use the default parameters."""
+    if header := read_file_header(path):
+        return header.salt, header.scrypt_n, header.scrypt_r, header.scrypt_p
+    with open(path, "rb") as file:
+        return file.read(16), SCRYPT_N, SCRYPT_R, SCRYPT_P
+
+
+@contextmanager
+def open_archive(
+    path: Path, password: str, key_cache: KeyCache | None = None
+) -> Iterator[zipfile.ZipFile]:
+    """Open an encrypted folder (*.zip.teax) for random access to its members.
+
+    The zip central directory inside the encrypted stream serves as the index of
+    members, so listing or extracting a member only decrypts the segments holding
+    the central directory and that member. Raises KeyError on incorrect password,
+    ValueError on corrupt data, compressed folders or files encrypted with versions
+    before segments."""
+    with open(path, "rb") as f_in:
+        if not (header := read_header(f_in)):
+            raise ValueError("Random access requires a segmented container")
+        if header.compression:
+            raise ValueError("Random access requires an uncompressed container")
+        key = decrypt_data_key(header, password, key_cache)
+        with SegmentReader(f_in, key, header) as reader:
+            with zipfile.ZipFile(reader) as archive:
+                yield archive
+
+
+def extract_members(
+    path: Path,
+    password: str,
+    members: list[str],
+    output_dir: Path,
+    key_cache: KeyCache | None = None,
+) -> list[Path]:
+    """Extract given members of an encrypted folder into output_dir
+    without decrypting the rest of it. Returns paths of extracted files."""
+    with open_archive(path, password, key_cache) as archive:
+        return [Path(archive.extract(member, output_dir)) for member in members]
+
+
+def encrypt_folder(
+    dir_path: Path,
+    dst: Path,
+    key: bytes,
+    header: Header,
+    chunk_size: int = CHUNK_SIZE,
+    timer: PhaseTimer | None = None,
+    compression_level: int | None = None,
+    threads: int = 1,
+) -> Iterator[int]:
+    """Zip folder straight into a new container dst, without a temporary archive.
+    The archive is compressed as a whole if header flags say so.
+    Yields number of plaintext bytes processed."""
+    timer = timer or PhaseTimer()
+    with open(dst, "wb") as f_out:
+        writer = SegmentWriter(f_out, key, header, timer)
+        sink: BinaryIO = writer
+        if header.compression:
+            sink = CompressingWriter(
+                writer, header.compression, compression_level, threads, timer
+            )
+        zipper = zip_folder(dir_path, sink, chunk_size, skip=dst, timer=timer)
+        # Whatever zip_folder spends outside of reading, cipher and writing
+        yield from timed_iter(zipper, timer, "archive")
+        sink.close()
+        writer.close()  # Write the last segment
+
+
+def zip_folder(
+    dir_path: Path,
+    sink: BinaryIO,
+    chunk_size: int = CHUNK_SIZE,
+    skip: Path | None = None,
+    timer: PhaseTimer | None = None,
+) -> Iterator[int]:
+    """Zip folder into sink without compression. The sink doesn't have to be seekable,
+    member sizes and checksums are then written after the data.
+    Yields number of member bytes written."""
+    timer = timer or PhaseTimer()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED) as archive:
         for path in dir_path.rglob("*"):
-            if path == archive_path:
+            if path == skip:
+                continue
+            arcname = path.relative_to(dir_path)
+            if path.is_dir():
+                archive.write(path, arcname)
                 continue
-            archive.write(path, path.relative_to(dir_path))
+
+            zinfo = zipfile.ZipInfo.from_file(path, arcname)
+            with open(path, "rb") as src, archive.open(zinfo, "w") as dest:
+                while True:
+                    with timer.phase("read"):
+                        chunk = src.read(chunk_size)
+                    if not chunk:
+                        break
+                    timer.add("read", 0, len(chunk))
+                    dest.write(chunk)
+                    yield len(chunk)
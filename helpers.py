@@ -1,7 +1,11 @@
 import os
+import queue
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
+from typing import Callable, Iterable, Iterator
 
 
 @dataclass(frozen=True)
@@ -10,6 +14,80 @@ class File:
     size: int
 
 
+class InputList:
+    """Files and folders added as inputs, in the order they were added. Names are
+    unique, so they index the entries. Folder flags, counts and the total size are
+    kept up to date, so showing the list doesn't stat anything."""
+
+    def __init__(self, files: Iterable[File] = ()) -> None:
+        self.clear()
+        for file in files:
+            self.add(file, file.path.is_dir())
+
+    def clear(self) -> None:
+        self.files: list[File] = []
+        self.index: dict[str, int] = {}
+        self.folders: set[str] = set()
+        self.total_size = 0
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def __iter__(self) -> Iterator[File]:
+        return iter(self.files)
+
+    def __getitem__(self, index: int) -> File:
+        return self.files[index]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.index
+
+    @property
+    def folder_count(self) -> int:
+        return len(self.folders)
+
+    @property
+    def file_count(self) -> int:
+        return len(self.files) - len(self.folders)
+
+    def add(self, file: File, is_dir: bool = False) -> bool:
+        """Add file unless one with the same name is added already."""
+        name = file.path.name
+        if name in self.index:
+            return False
+        self.index[name] = len(self.files)
+        self.files.append(file)
+        if is_dir:
+            self.folders.add(name)
+        self.total_size += file.size
+        return True
+
+    def update_size(self, path: Path, size: int) -> None:
+        index = self.index.get(path.name)
+        if index is not None and self.files[index].path == path:
+            self.total_size += size - self.files[index].size
+            self.files[index] = File(path, size)
+
+    def remove_missing(self) -> list[File]:
+        """Remove files that no longer exist, checked by several threads.
+        Returns removed files."""
+        step = -(-len(self.files) // SCAN_THREADS) or 1
+        parts = [self.files[i : i + step] for i in range(0, len(self.files), step)]
+        with ThreadPoolExecutor(max_workers=SCAN_THREADS) as executor:
+            checked = executor.map(
+                lambda part: [os.path.exists(f.path) for f in part], parts
+            )
+            exists = [file_exists for part in checked for file_exists in part]
+        if all(exists):
+            return []
+        files, folders = self.files, self.folders
+        self.clear()
+        for file, file_exists in zip(files, exists):
+            if file_exists:
+                self.add(file, file.path.name in folders)
+        return [file for file, file_exists in zip(files, exists) if not file_exists]
+
+
 def resource_path(relative_path: str) -> Path:
     """PyInstaller filepaths fix. Works for dev env too."""
     try:
@@ -20,22 +98,134 @@ def resource_path(relative_path: str) -> Path:
     return base_path / relative_path
 
 
-def path_size(path: Path) -> int:
-    """Return total size of a file or directory in bytes.
-    Slightly modified version from https://peps.python.org/pep-0471/#examples"""
-    total_size = 0
-    try:
+SCAN_THREADS = 8  # Directories scanned at once, scandir releases the GIL
+
+
+class TreeScanner:
+    """Computes total sizes of folders, scanning their subdirectories concurrently.
+
+    Every directory is cached by path along with its modification time, sizes of
+    the files directly in it and its subdirectories. A directory whose
+    modification time hasn't changed isn't listed again, only its subdirectories
+    are checked. Files modified in place don't change the modification time of
+    their directory, so their old size may be reported until it is rescanned."""
+
+    def __init__(self, threads: int = SCAN_THREADS) -> None:
+        self.threads = threads
+        self.cache: dict[str, tuple[int, int, list[str]]] = {}
+        self.scanned = 0  # Directories listed, not taken from the cache
+
+    def size(
+        self,
+        path: Path,
+        on_progress: Callable[[int], None] | None = None,
+        cancel: threading.Event | None = None,
+    ) -> int:
+        """Total size of a file or folder in bytes. on_progress is called with
+        the partial total as directories are done. Returns the partial total
+        if cancelled. Raises FileNotFoundError if path doesn't exist."""
         if path.is_file():
             return path.stat().st_size
-        for entry in os.scandir(path):
-            if entry.is_dir(follow_symlinks=False):
-                total_size += path_size(Path(entry.path))
+        total, subdirs = self.scan_dir(str(path), root=True)
+        results: queue.Queue = queue.Queue()
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+
+            def submit(directory: str) -> None:
+                future = executor.submit(self.scan_dir, directory)
+                future.add_done_callback(results.put)
+
+            for directory in subdirs:
+                submit(directory)
+            pending = len(subdirs)
+            while pending and not (cancel and cancel.is_set()):
+                size, subdirs = results.get().result()
+                pending -= 1
+                total += size
+                for directory in subdirs:
+                    submit(directory)
+                pending += len(subdirs)
+                if on_progress:
+                    on_progress(total)
+            if pending:  # Cancelled
+                executor.shutdown(wait=True, cancel_futures=True)
+        return total
+
+    def scan_dir(self, directory: str, root: bool = False) -> tuple[int, list[str]]:
+        """Size of files in directory and in its unchanged cached subdirectories,
+        which are walked right away. Returns subdirectories that still have to be
+        scanned. Unreadable directories are skipped, so is a missing one unless
+        it is the root."""
+        total = 0
+        unknown = []
+        stack = [directory]
+        while stack:
+            current = stack.pop()
+            try:
+                mtime = os.stat(current).st_mtime_ns
+            except FileNotFoundError:
+                if root and current == directory:
+                    raise
+                continue
+            except PermissionError:
+                continue
+            cached = self.cache.get(current)
+            if cached and cached[0] == mtime:
+                total += cached[1]
+                stack.extend(cached[2])
+            elif current == directory:
+                size, subdirs = self.list_dir(current, mtime)
+                total += size
+                unknown.extend(subdirs)
             else:
-                total_size += entry.stat(follow_symlinks=False).st_size
-    except PermissionError:
-        pass
+                unknown.append(current)  # Listed by another task
+        return total, unknown
+
+    def list_dir(self, directory: str, mtime: int) -> tuple[int, list[str]]:
+        size = 0
+        subdirs = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    else:
+                        size += entry.stat(follow_symlinks=False).st_size
+        except (FileNotFoundError, PermissionError):
+            return 0, []
+        self.cache[directory] = mtime, size, subdirs
+        self.scanned += 1
+        return size, subdirs
+
+
+scanner = TreeScanner()
+
+
+def path_size(path: Path) -> int:
+    """Return total size of a file or directory in bytes (see TreeScanner)."""
+    return scanner.size(path)
+
+
+def derive_path(path: Path, mode: str, output_dir: Path | None) -> Path:
+    """Output path for an input path in given mode ("_enc" or "_dec")."""
+    if mode == "_enc":
+        if path.is_dir():
+            file_out = Path(f"{path}.zip.teax")
+        else:
+            file_out = Path(f"{path}.teax")
+
+    elif mode == "_dec":
+        if str(path).endswith(".teax"):
+            file_out = path.with_suffix("")  # Remove .teax suffix
+        else:
+            file_out = path
+
+    else:
+        raise RuntimeError
+
+    if output_dir:
+        file_out = output_dir / file_out.name
 
-    return total_size
+    return file_out
 
 
 def human_readable_size(num: int) -> str:
@@ -1,6 +1,16 @@
+import time
+
+STARTED = time.perf_counter()  # Start of the imports, see report_startup
+
+import functools
+import importlib
+import json
 import multiprocessing as mp
+import queue
 import secrets
+import stat
 import sys
+import threading
 import webbrowser
 from pathlib import Path
 from typing import Any
@@ -9,12 +19,37 @@ import dearpygui.dearpygui as dpg
 import dearpygui_extend as dpge
 
 import theme
-from core import decrypt_files, encrypt_files
-from helpers import File, human_readable_size, path_size, resource_path
+from helpers import (
+    File,
+    InputList,
+    derive_path,
+    human_readable_size,
+    resource_path,
+    scanner,
+)
+from progress import Progress, describe
+from timing import PhaseTimer
+
+IMPORTED = time.perf_counter()
 
 # Modes: "_enc" = encryption, "_dec" = decryption
 
+# Chunk size options of the settings tab, None = chosen per file
+CHUNK_SIZES: dict[str, int | None] = {
+    "Auto": None,
+    "1 MiB": 1024**2,
+    "4 MiB": 4 * 1024**2,
+    "16 MiB": 16 * 1024**2,
+    "64 MiB": 64 * 1024**2,
+}
+
+# Rows of an input list shown at once. Only these widgets exist, whatever the number
+# of files, and the mouse wheel scrolls through the list (see render_rows).
+VISIBLE_ROWS = 10
+SCROLL_ROWS = 3  # Rows per mouse wheel step
 
+
+@functools.cache
 def load_wordlist() -> list[str]:
     path = resource_path("resources/wordlist.txt")
     with open(path, "r", encoding="utf-8") as file:
@@ -28,14 +63,20 @@ def main() -> None:
 
 class App:
     def __init__(self) -> None:
-        self.files_in: dict[str, list[File]] = {"_enc": [], "_dec": []}
+        self.files_in: dict[str, InputList] = {"_enc": InputList(), "_dec": InputList()}
+        self.row_offset: dict[str, int] = {"_enc": 0, "_dec": 0}
         self.popup: Popup | None = None
+        self.processing_thread: threading.Thread | None = None
+        self.file_browser = FileBrowser()
+        # Folders whose size is being computed, see scan_folders
+        self.scanning: dict[str, set[Path]] = {"_enc": set(), "_dec": set()}
+        self.scan_results: queue.Queue = queue.Queue()
+        self.scan_cancel = {"_enc": threading.Event(), "_dec": threading.Event()}
         self.version: str = "1.2"
         self.project_url: str = "https://github.com/70sh1/Vaultea"
 
-    def setup_and_spawn_window(
-        self, filebrowser_args: tuple[str, bool, Any] | None = None
-    ) -> None:
+    @staticmethod
+    def setup_context() -> None:
         dpg.create_context()
         dpg.setup_dearpygui()
 
@@ -43,33 +84,15 @@ class App:
         theme.load_icons()
         theme.load_fonts()
 
+    @staticmethod
+    def create_viewport(title: str, **geometry: int) -> None:
         icon = resource_path("resources/icons/Vaultea.ico")
-        if not filebrowser_args:
-            viewport_height = 395 if PLATFORM == "linux" else 435
-            dpg.create_viewport(
-                title="Vaultea",
-                large_icon=str(icon),
-                small_icon=str(icon),
-                width=450,
-                height=viewport_height,
-                x_pos=735,
-                y_pos=320,
-            )
-            self.main_window()
-        else:
-            _, output, _ = filebrowser_args
-            title = "Select folder..." if output else "Select files..."
-            dpg.create_viewport(
-                title=title,
-                large_icon=str(icon),
-                small_icon=str(icon),
-                width=750,
-                height=555,
-                x_pos=585,
-                y_pos=260,
-            )
-            self.filebrowser_window(*filebrowser_args)
+        dpg.create_viewport(
+            title=title, large_icon=str(icon), small_icon=str(icon), **geometry
+        )
 
+    @staticmethod
+    def show_viewport() -> None:
         dpg.show_viewport()
 
         dpg.bind_font("JetBrainsMono")
@@ -79,27 +102,69 @@ class App:
         # dpg.show_item_registry()
         # dpg.show_metrics()
 
+    def setup_and_spawn_window(self) -> None:
+        timer = PhaseTimer()
+        timer.add("imports", IMPORTED - STARTED)
+        with timer.phase("context"):
+            self.setup_context()
+        with timer.phase("window"):
+            viewport_height = 395 if PLATFORM == "linux" else 435
+            self.create_viewport(
+                "Vaultea", width=450, height=viewport_height, x_pos=735, y_pos=320
+            )
+            self.main_window()
+            self.show_viewport()
+        with timer.phase("first_frame"):
+            dpg.render_dearpygui_frame()
+
+        if "--startup-timing" in sys.argv:
+            self.report_startup(timer)
+            dpg.destroy_context()
+            return
+
+        # Crypto modules are imported only when needed, and the file browser process
+        # started, while the user looks at the window
+        threading.Thread(
+            target=importlib.import_module, args=("parallel",), daemon=True
+        ).start()
+        self.file_browser.start()
+
         # Main loop of a window
         while dpg.is_dearpygui_running():
             self.update_current_popup_width()
+            self.poll_scanning()
+            self.poll_processing()
             dpg.render_dearpygui_frame()
 
+        self.file_browser.close()
+
+    @staticmethod
+    def report_startup(timer: PhaseTimer) -> None:
+        """Print seconds spent on each step up to the first frame as JSON."""
+        report = {"event": "startup", **timer.report()["phases"]}
+        report["total"] = round(time.perf_counter() - STARTED, 6)
+        print(json.dumps(report), flush=True)
+
     def update_current_popup_width(self):
         if self.popup:
             self.popup.update_width()
 
     def main_window(self) -> None:
         """Populates main window with widgets."""
+        with dpg.handler_registry():
+            dpg.add_mouse_wheel_handler(callback=self.scroll_rows)
+
         with dpg.window(tag="main_window", no_title_bar=True):
             with dpg.tab_bar():
                 # Encrypt tab
                 with dpg.tab(label="Encrypt", tag="encrypt_tab"):
                     dpg.add_spacer()
                     dpg.add_text("Input:")
-                    dpg.add_collapsing_header(
+                    with dpg.collapsing_header(
                         label="No files",
                         tag="input_header_enc",
-                    )
+                    ):
+                        self.input_rows("_enc")
                     with dpg.group(horizontal=True):
                         dpg.add_button(
                             label="Add",
@@ -201,10 +266,11 @@ class App:
                     dpg.add_spacer()
 
                     dpg.add_text("Input:")
-                    dpg.add_collapsing_header(
+                    with dpg.collapsing_header(
                         label="No files",
                         tag="input_header_dec",
-                    )
+                    ):
+                        self.input_rows("_dec")
                     with dpg.group(horizontal=True):
                         dpg.add_button(
                             label="Add",
@@ -278,6 +344,23 @@ class App:
 
                 dpg.add_tab_button(label="Reset", callback=self.reset)
 
+                # Settings tab
+                with dpg.tab(label="Settings", tag="settings_tab"):
+                    dpg.add_spacer()
+                    dpg.add_text("Chunk size:")
+                    dpg.add_combo(
+                        items=list(CHUNK_SIZES),
+                        default_value="Auto",
+                        tag="chunk_size_combo",
+                        width=-1,
+                    )
+                    with dpg.tooltip(parent="chunk_size_combo"):
+                        dpg.add_text(
+                            "Amount of data read and encrypted at once. Auto picks it"
+                            " for every file based on its size and storage speed.",
+                            wrap=310,
+                        )
+
                 # About tab
                 with dpg.tab(label="About", tag="about_tab"):
                     dpg.add_text(f"v{self.version}")
@@ -305,6 +388,9 @@ class App:
     def filebrowser_window(
         self, mode: str, output_select: bool, connection: Any
     ) -> None:
+        """Show a file browser dialog in the current context. The selection, or None
+        if cancelled, is sent through connection and ends the render loop."""
+        self.paths_sent = False
         allow_multi_selection = not output_select
         filetype_filter = None
         filetype_filter_default = 0
@@ -340,37 +426,14 @@ class App:
             )
         dpg.set_primary_window("fb", True)
 
-    @staticmethod
-    def send_paths(paths: list, cancel_pressed: bool, connection: Any) -> None:
-        if cancel_pressed:
-            connection.send(None)
-        else:
-            connection.send(paths)
-
-        connection.close()
+    def send_paths(self, paths: list, cancel_pressed: bool, connection: Any) -> None:
+        if not self.paths_sent:
+            connection.send(None if cancel_pressed else paths)
+            self.paths_sent = True
+        dpg.stop_dearpygui()
 
     def filebrowser(self, mode: str, output_select: bool = False) -> list[Path]:
-        paths = []
-        read_conn, write_conn = mp.Pipe(duplex=False)
-        filebrowser_args = mode, output_select, write_conn
-        file_browser_process = mp.Process(
-            target=self.setup_and_spawn_window, args=(filebrowser_args,), daemon=True
-        )
-
-        file_browser_process.start()
-        while file_browser_process.is_alive():
-            if read_conn.poll():
-                paths = read_conn.recv()
-                file_browser_process.terminate()
-
-        file_browser_process.join()
-        write_conn.close()
-        read_conn.close()
-
-        if paths:
-            paths = [Path(path) for path in paths]  # Convert paths to pathlib Path
-
-        return paths
+        return self.file_browser.select(mode, output_select)
 
     def add_files(self, sender: str) -> None:
         dpg.disable_item(sender)
@@ -427,7 +490,12 @@ class App:
 
     def clear_files(self, sender: str) -> None:
         mode = sender[-4:]
-        self.files_in[mode] = []
+        self.files_in[mode] = InputList()
+        if self.scanning[mode]:
+            # Results of running scans are ignored from now on
+            self.scan_cancel[mode].set()
+            self.scan_cancel[mode] = threading.Event()
+            self.scanning[mode] = set()
         self.update_header(self.files_in, mode)
         self.update_encrypt_button_state()
         self.update_decrypt_button_state()
@@ -435,19 +503,11 @@ class App:
     def validate_old_paths(self, mode: str) -> bool:
         """Check that previously added files still exist.
         Remove invalid paths and show notice(s) otherwise."""
-        messages = []
-        valid_paths = []
-
-        for file in self.files_in[mode]:
-            if file.path.exists():
-                valid_paths.append(file)
-            else:
-                messages.append(
-                    f"File {file.path} not found. Perhaps it was renamed, moved or deleted."
-                    " It is now removed from the input list."
-                )
-
-        self.files_in[mode] = valid_paths
+        messages = [
+            f"File {file.path} not found. Perhaps it was renamed, moved or deleted."
+            " It is now removed from the input list."
+            for file in self.files_in[mode].remove_missing()
+        ]
 
         if messages:
             self.update_header(self.files_in, mode)
@@ -462,9 +522,9 @@ class App:
         return True
 
     def update_files_list(self, mode: str, paths: list[Path]) -> None:
-        too_big: list[tuple[str, int]] = []
         not_unique: list[str] = []
         doesnt_exist: list[str] = []
+        not_encrypted: list[str] = []
         messages: list[str] = []
 
         if mode == "_dec":
@@ -475,34 +535,37 @@ class App:
             if folder_flag:
                 messages.append("Cannot add folders in decryption mode.")
 
+            from core import sniff_file
+
+            # Only the header is read, junk files would otherwise cost
+            # a key derivation each when processed
+            encrypted: list[Path] = []
+            for path in paths:
+                if sniff_file(path) or not path.exists():
+                    encrypted.append(path)
+                else:
+                    not_encrypted.append(path.name)
+            paths = encrypted
+
+        folders: list[Path] = []
         for path in paths:
             # Try to get filesize. Also checks if file exists.
+            # Folders are added with size 0 and scanned in the background.
             try:
-                size = path_size(path)
+                info = path.stat()
             except FileNotFoundError:
                 doesnt_exist.append(path.name)
                 continue
+            is_dir = stat.S_ISDIR(info.st_mode)
 
-            # Сheck if file is too big.
-            if size > MAX_FILESIZE:
-                file_info = path.name, size
-                too_big.append(file_info)
-                continue
-
-            # Сheck if filename is unique.
-            currently_added = self.files_in[mode]
-            for file in currently_added:
-                if file.path.name == path.name:
-                    not_unique.append(path.name)
-                    break
-            else:
-                self.files_in[mode].append(File(path, size))
+            # Filenames have to be unique
+            if not self.files_in[mode].add(
+                File(path, 0 if is_dir else info.st_size), is_dir
+            ):
+                not_unique.append(path.name)
+            elif is_dir:
+                folders.append(path)
 
-        for i in too_big:
-            messages.append(
-                f"File/folder '{i[0]}' is too big {human_readable_size(i[1])}."
-                "\n\nThe limit is 256 GiB per file/folder."
-            )
         for i in not_unique:
             messages.append(
                 f"File/folder with name '{i}' is already added."
@@ -510,6 +573,8 @@ class App:
             )
         for i in doesnt_exist:
             messages.append(f"File/folder '{i}' not found.")
+        for i in not_encrypted:
+            messages.append(f"File '{i}' is not encrypted with Vaultea.")
 
         if messages:
             self.popup = Popup(
@@ -519,31 +584,122 @@ class App:
             )
             self.popup.notice()
 
+        if folders:
+            self.scan_folders(mode, folders)
         self.update_header(self.files_in, mode)
 
+    def scan_folders(self, mode: str, folders: list[Path]) -> None:
+        """Compute sizes of folders in a background thread, which reports partial
+        totals through a queue. The queue is drained by the render loop
+        (see poll_scanning). Encryption is disabled until all sizes are known."""
+        self.scanning[mode].update(folders)
+        threading.Thread(
+            target=self.scanning_worker,
+            args=(mode, folders, self.scan_results, self.scan_cancel[mode]),
+            daemon=True,
+        ).start()
+
+    @staticmethod
+    def scanning_worker(
+        mode: str,
+        folders: list[Path],
+        results: queue.Queue,
+        cancel: threading.Event,
+    ) -> None:
+        for folder in folders:
+
+            def report(total: int, folder: Path = folder) -> None:
+                results.put((cancel, mode, folder, total, False))
+
+            try:
+                total = scanner.size(folder, report, cancel)
+            except OSError:
+                total = 0
+            results.put((cancel, mode, folder, total, True))
+
+    def poll_scanning(self) -> None:
+        """Apply folder sizes reported since the last frame."""
+        sizes: dict[tuple[str, Path], int] = {}
+        finished = False
+        while True:
+            try:
+                cancel, mode, folder, total, done = self.scan_results.get_nowait()
+            except queue.Empty:
+                break
+            if cancel.is_set():
+                continue
+            sizes[mode, folder] = total
+            if done:
+                self.scanning[mode].discard(folder)
+                finished = True
+
+        for (mode, folder), total in sizes.items():
+            self.files_in[mode].update_size(folder, total)
+        for mode in {mode for mode, _ in sizes}:
+            self.update_header_label(self.files_in, mode, bool(self.scanning[mode]))
+        if finished:
+            self.update_encrypt_button_state()
+            self.update_decrypt_button_state()
+
     def filter_dirs(self, paths: list[Path]) -> tuple[bool, list[Path]]:
         no_dirs = [path for path in paths if not path.is_dir()]
         return (paths != no_dirs), no_dirs
 
     @staticmethod
-    def update_header(paths: dict[str, list[File]], mode: str) -> None:
-        """Repopulate input header with filenames and path tooltips."""
-        dpg.delete_item("input_header" + mode, children_only=True)
-        total_size = 0
-        file_count = 0
-        dir_count = 0
-        for file in paths[mode]:
-            dpg.add_text(file.path.name, wrap=0, parent="input_header" + mode)
-            total_size += file.size
-            with dpg.tooltip(parent=dpg.last_item()):
-                dpg.add_text(str(file.path), wrap=350)
-
-            if file.path.is_file():
-                file_count += 1
-            elif file.path.is_dir():
-                dir_count += 1
-
-        readable_size = human_readable_size(total_size)
+    def input_rows(mode: str) -> None:
+        """Create the rows of an input list, filled in by render_rows."""
+        with dpg.group(tag="input_rows" + mode):
+            for row in range(VISIBLE_ROWS):
+                dpg.add_text("", wrap=0, tag=f"input_row{mode}{row}", show=False)
+                with dpg.tooltip(parent=dpg.last_item()):
+                    dpg.add_text("", wrap=350, tag=f"input_row_path{mode}{row}")
+            dpg.add_text("", tag="input_rows_position" + mode, show=False)
+
+    def render_rows(self, mode: str) -> None:
+        """Show the files of the input list that are scrolled into view."""
+        files = self.files_in[mode]
+        offset = max(0, min(self.row_offset[mode], len(files) - VISIBLE_ROWS))
+        self.row_offset[mode] = offset
+        for row in range(VISIBLE_ROWS):
+            if offset + row < len(files):
+                path = files[offset + row].path
+                dpg.set_value(f"input_row{mode}{row}", path.name)
+                dpg.set_value(f"input_row_path{mode}{row}", str(path))
+                dpg.show_item(f"input_row{mode}{row}")
+            else:
+                dpg.hide_item(f"input_row{mode}{row}")
+
+        if len(files) > VISIBLE_ROWS:
+            last = offset + VISIBLE_ROWS
+            position = f"{offset + 1}-{last} of {len(files)}, scroll for more"
+            dpg.set_value("input_rows_position" + mode, position)
+            dpg.show_item("input_rows_position" + mode)
+        else:
+            dpg.hide_item("input_rows_position" + mode)
+
+    def scroll_rows(self, sender: str, app_data: int) -> None:
+        """Mouse wheel handler, scrolls the input list under the cursor."""
+        for mode in self.files_in:
+            if dpg.is_item_hovered("input_rows" + mode):
+                self.row_offset[mode] -= int(app_data) * SCROLL_ROWS
+                self.render_rows(mode)
+
+    def update_header(self, paths: dict[str, InputList], mode: str) -> None:
+        """Show input files in the header. Only the visible rows are rendered."""
+        self.render_rows(mode)
+        self.update_header_label(paths, mode, bool(self.scanning[mode]))
+
+    @staticmethod
+    def update_header_label(
+        paths: dict[str, InputList], mode: str, scanning: bool = False
+    ) -> None:
+        """Show file and folder counts and their total size in the input header."""
+        file_count = paths[mode].file_count
+        dir_count = paths[mode].folder_count
+
+        readable_size = human_readable_size(paths[mode].total_size)
+        if scanning:
+            readable_size = f"{readable_size[:-1]}, counting...)"
 
         # There is high chance the following part can be written better and more consice
         if dir_count == 1:
@@ -574,7 +730,11 @@ class App:
     def update_encrypt_button_state(self) -> None:
         pass_value = dpg.get_value("pass_input_enc")
         confirm_pass_value = dpg.get_value("confirm_pass_input")
-        if (pass_value or confirm_pass_value) and self.files_in["_enc"]:
+        if (
+            (pass_value or confirm_pass_value)
+            and self.files_in["_enc"]
+            and not self.scanning["_enc"]
+        ):
             if pass_value == confirm_pass_value:
                 dpg.enable_item("encrypt_button")
                 dpg.hide_item("encrypt_button_disabled_tooltip")
@@ -589,7 +749,7 @@ class App:
             dpg.hide_item("passwords_do_not_match_tooltip")
 
     def update_decrypt_button_state(self) -> None:
-        if self.files_in["_dec"]:
+        if self.files_in["_dec"] and not self.scanning["_dec"]:
             dpg.enable_item("decrypt_button")
             dpg.hide_item("decrypt_button_disabled_tooltip")
         else:
@@ -622,7 +782,7 @@ class App:
 
     @staticmethod
     def generate_passphrase(length: int) -> str:
-        return "-".join([secrets.choice(WORDLIST) for _ in range(length)])
+        return "-".join([secrets.choice(load_wordlist()) for _ in range(length)])
 
     @staticmethod
     def copy_password() -> None:
@@ -641,7 +801,7 @@ class App:
         self.preprocess_files(self.files_in, "_dec", output_dir)
 
     def preprocess_files(
-        self, files_in: dict[str, list[File]], mode: str, output_dir: Path | None
+        self, files_in: dict[str, InputList], mode: str, output_dir: Path | None
     ) -> None:
         if not self.validate_old_paths(mode):
             return
@@ -664,7 +824,7 @@ class App:
 
         # Construct file_out path from input file path
         for file in files_in[mode]:
-            file_out = self.derive_path(file.path, mode, output_dir)
+            file_out = derive_path(file.path, mode, output_dir)
             self.files_in_out[file] = file_out
             if file_out.exists():
                 existing_files.append(file_out)
@@ -684,27 +844,6 @@ class App:
 
         self.process_files(self.files_in_out, self.mode)
 
-    def derive_path(self, path: Path, mode: str, output_dir: Path | None) -> Path:
-        if mode == "_enc":
-            if path.is_dir():
-                file_out = Path(f"{path}.zip.teax")
-            else:
-                file_out = Path(f"{path}.teax")
-
-        elif mode == "_dec":
-            if str(path).endswith(".teax"):
-                file_out = path.with_suffix("")  # Remove .teax suffix
-            else:
-                file_out = path
-
-        else:
-            raise RuntimeError
-
-        if output_dir:
-            file_out = output_dir / file_out.name
-
-        return file_out
-
     def overwrite_selection(self, sender: str) -> None:
         self.popup = None
         dpg.delete_item("overwrite_dialog_popup")
@@ -718,13 +857,7 @@ class App:
         dpg.configure_viewport("Vaultea", disable_close=True)
 
         password = dpg.get_value("pass_input" + mode)
-
-        if mode == "_enc":
-            processor = encrypt_files
-            message = "Encrypting"
-        else:
-            processor = decrypt_files
-            message = "Decrypting"
+        chunk_size = CHUNK_SIZES[dpg.get_value("chunk_size_combo")]
 
         self.popup = Popup(
             title="Processing",
@@ -734,17 +867,96 @@ class App:
         )
         self.popup.progress_bar()
 
-        skipped_files: list[File] = []
-        max_progress = len(files)
-        for result in processor(files, password):
-            if type(result[0]) in (int, float, complex):
-                progress, filename = result
-                dpg.set_value("popup_text", f"{message} '{filename}'...")
-                dpg.set_value("progress_bar", progress / max_progress)
-            elif result[0] is False:
+        # Files are processed in a background thread, which updates the progress
+        # and reports other results through the queue. Both are read by the render
+        # loop (see poll_processing).
+        self.skipped_files: list[File] = []
+        self.progress = Progress([file.size for file in files])
+        self.results: queue.Queue = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.processing_thread = threading.Thread(
+            target=self.processing_worker,
+            args=(
+                files,
+                password,
+                mode,
+                chunk_size,
+                self.progress,
+                self.results,
+                self.cancel_event,
+            ),
+            daemon=True,
+        )
+        self.processing_thread.start()
+
+    @staticmethod
+    def processing_worker(
+        files: dict[File, Path],
+        password: str,
+        mode: str,
+        chunk_size: int | None,
+        progress: Progress,
+        results: queue.Queue,
+        cancel_event: threading.Event,
+    ) -> None:
+        from parallel import process_files_parallel
+
+        processor = process_files_parallel(
+            files, password, mode, chunk_size=chunk_size, progress=progress
+        )
+        try:
+            for result in processor:
+                if cancel_event.is_set():
+                    break
+                # Progress is read from the Progress object instead
+                if type(result[0]) in (int, float, complex):
+                    continue
+                results.put(result)
+                # Any result except skipped file is an error
+                if result[0] is not False:
+                    break
+        except Exception as err:
+            results.put((err, progress.name))
+        finally:
+            processor.close()  # Deletes partial .tmp output
+            results.put(None)  # Processing finished or cancelled
+
+    def cancel_processing(self) -> None:
+        self.cancel_event.set()
+        dpg.disable_item("progress_popup_cancel_button")
+        dpg.set_value("popup_text", "Cancelling...")
+
+    def poll_processing(self) -> None:
+        """Handle results reported by the processing thread since the last frame."""
+        if not self.processing_thread:
+            return
+
+        if not self.cancel_event.is_set() and (report := self.progress.poll()):
+            if report["file"]:
+                message = "Encrypting" if self.mode == "_enc" else "Decrypting"
+                dpg.set_value("popup_text", f"{message} '{report['file']}'...")
+            dpg.set_value("progress_bar", report["progress"])
+            dpg.configure_item("progress_bar", overlay=describe(report))
+
+        while True:
+            try:
+                result = self.results.get_nowait()
+            except queue.Empty:
+                return
+
+            if result is None:
+                self.processing_thread = None
+                self.finish_processing()
+                return
+
+            if self.cancel_event.is_set():
+                continue
+
+            if result[0] is False:
                 failed_file = result[1]
-                skipped_files.append(failed_file)
+                self.skipped_files.append(failed_file)
             else:
+                self.processing_thread = None
                 dpg.delete_item("progress_bar_popup")
                 err = repr(result[0])
                 failed_file = result[1]
@@ -760,14 +972,23 @@ class App:
                 dpg.configure_viewport("Vaultea", disable_close=False)
                 return
 
+    def finish_processing(self) -> None:
         dpg.configure_viewport("Vaultea", disable_close=False)
+        dpg.delete_item("pb_loading_indicator")
+        dpg.disable_item("progress_popup_cancel_button")
+        dpg.enable_item("progress_popup_close_button")
+
+        if self.cancel_event.is_set():
+            dpg.set_value("popup_text", "Cancelled.")
+            return
+
         dpg.set_value("progress_bar", 1)
+        dpg.configure_item("progress_bar", overlay="100%")
         dpg.set_value("popup_text", "Done.")
-        dpg.delete_item("pb_loading_indicator")
         dpg.add_image("checkmark", parent="pb_row")
-        dpg.enable_item("progress_popup_close_button")
 
-        self.files_in[self.mode] = skipped_files
+        skipped_files = self.skipped_files
+        self.files_in[self.mode] = InputList(skipped_files)
         self.update_header(self.files_in, self.mode)
 
         if skipped_files:
@@ -785,6 +1006,75 @@ class App:
             return
 
 
+class FileBrowser:
+    """File browser dialogs shown by a long-lived process. Spawning a process,
+    importing DearPyGui and loading fonts take seconds, so it is done once, ahead
+    of time, and a new dialog only needs a viewport."""
+
+    def __init__(self) -> None:
+        self.process: mp.Process | None = None
+        self.connection: Any = None
+
+    def start(self) -> None:
+        if self.process and self.process.is_alive():
+            return
+        self.connection, child_connection = mp.Pipe()
+        self.process = mp.Process(
+            target=filebrowser_worker, args=(child_connection,), daemon=True
+        )
+        self.process.start()
+        child_connection.close()  # Receiving then fails if the process dies
+
+    def select(self, mode: str, output_select: bool) -> list[Path]:
+        """Show a dialog and wait for the selection, blocked on the pipe.
+        Returns an empty list if cancelled."""
+        self.start()
+        try:
+            self.connection.send((mode, output_select))
+            paths = self.connection.recv()
+        except (EOFError, OSError):  # Process died, the next dialog starts a new one
+            self.process = None
+            paths = None
+        return [Path(path) for path in paths] if paths else []
+
+    def close(self) -> None:
+        if not self.process:
+            return
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process = None
+
+
+def filebrowser_worker(connection: Any) -> None:
+    """Body of the file browser process. A new context is set up before each
+    request arrives, so a dialog only has to create its viewport. DearPyGui can't
+    hide a viewport once shown, so the context is destroyed after every dialog."""
+    app = App()
+    while True:
+        app.setup_context()
+        try:
+            request = connection.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+
+        mode, output_select = request
+        title = "Select folder..." if output_select else "Select files..."
+        app.create_viewport(title, width=750, height=555, x_pos=585, y_pos=260)
+        app.filebrowser_window(mode, output_select, connection)
+        app.show_viewport()
+        dpg.start_dearpygui()
+        if not app.paths_sent:  # Viewport was closed
+            connection.send(None)
+        dpg.destroy_context()
+
+
 class Popup:
     """Create base popup window.
 
@@ -884,6 +1174,13 @@ class Popup:
             dpg.add_progress_bar(tag="progress_bar", width=-25)
             dpg.add_loading_indicator(tag="pb_loading_indicator", radius=1.3, style=1)
         dpg.add_spacer(height=10, parent=self.tag)
+        dpg.add_button(
+            parent=self.tag,
+            label="Cancel",
+            tag="progress_popup_cancel_button",
+            width=-1,
+            callback=self.app.cancel_processing,
+        )
         dpg.add_button(
             parent=self.tag,
             label="Close",
@@ -906,7 +1203,5 @@ class Popup:
 if __name__ == "__main__":
     mp.freeze_support()  # Required for correct filebrowser spawn when run from dist
     mp.set_start_method("spawn")  # Required for filebrowser spawn on linux
-    WORDLIST: list[str] = load_wordlist()
-    MAX_FILESIZE: int = 524_288**2  # 256 GiB
     PLATFORM = sys.platform
     main()
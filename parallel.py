@@ -0,0 +1,280 @@
+import multiprocessing as mp
+import os
+import queue
+import time
+from collections import Counter
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Iterator
+
+from core import (
+    SCRYPT_MEMORY,
+    Key,
+    KeyCache,
+    decrypt_files,
+    encrypt_files,
+    read_key_params,
+    sniff_file,
+    verify_files,
+)
+from helpers import File
+from progress import Progress
+from timing import EventCallback
+
+DEFAULT_MEMORY_BUDGET = 4 * 1024**3  # 4 GiB
+FORWARD_INTERVAL = 0.05  # Seconds between progress results sent by a worker
+
+# Modes: "_enc" = encryption, "_dec" = decryption, "_ver" = verification
+PROCESSORS = {"_enc": encrypt_files, "_dec": decrypt_files, "_ver": verify_files}
+
+# Worker process globals, set by init_worker
+_results: Any = None
+_cancel: Any = None
+
+
+def worker_count(
+    workers: int | None, memory_budget: int, scrypt_memory: int = SCRYPT_MEMORY
+) -> int:
+    """Number of worker processes allowed by the CPU count and the memory budget.
+    Every worker may run scrypt at the same time, which needs up to scrypt_memory
+    of RAM."""
+    if not workers:
+        workers = os.cpu_count() or 1
+    return max(1, min(workers, memory_budget // scrypt_memory))
+
+
+def init_worker(results: Any, cancel: Any) -> None:
+    global _results, _cancel
+    _results, _cancel = results, cancel
+
+
+def process_file(
+    mode: str,
+    index: int,
+    file_in: File,
+    file_out: Path,
+    password: str,
+    keys: Any,
+    threads: int,
+    chunk_size: int | None,
+    events: bool,
+    options: dict[str, Any],
+):
+    """Run a single file through the regular processor inside a worker process
+    and forward everything it yields to the parent, tagged with the file index.
+    Progress is sent at most once per FORWARD_INTERVAL.
+    With events, instrumentation events are forwarded as well.
+    options are passed on to the processor as keyword arguments."""
+    processor = PROCESSORS[mode]
+    on_event = (lambda event: _results.put((index, event))) if events else None
+    results = processor(
+        {file_in: file_out}, password, keys, threads, chunk_size, on_event, **options
+    )
+    last_sent = 0.0
+    try:
+        for result in results:
+            if _cancel.is_set():
+                break
+            if type(result[0]) in (int, float, complex):
+                if time.monotonic() - last_sent < FORWARD_INTERVAL:
+                    continue
+                last_sent = time.monotonic()
+            _results.put((index, result))
+    finally:
+        results.close()  # Removes partial .tmp output if cancelled
+        if isinstance(keys, KeyCache):
+            keys.clear()
+        _results.put((index, None))  # Done marker
+
+
+def process_files_parallel(
+    files: dict[File, Path],
+    password: str,
+    mode: str,
+    workers: int | None = None,
+    memory_budget: int = DEFAULT_MEMORY_BUDGET,
+    batch_key: bool = True,
+    key_cache: KeyCache | None = None,
+    chunk_size: int | None = None,
+    on_event: EventCallback | None = None,
+    compression: str | None = None,
+    compression_level: int | None = None,
+    progress: Progress | None = None,
+) -> Iterator:
+    """Process files in a pool of worker processes.
+
+    Yields the same results as encrypt_files/decrypt_files/verify_files do
+    (output paths are ignored when verifying), with progress being
+    the sum of per-file progress of all the files.
+
+    With batch_key, the password key is derived once for the whole batch when
+    encrypting. When decrypting, keys of salts and scrypt parameters shared by
+    several files are derived once through key_cache (a new one is used for this
+    call if not given).
+    Chunk size is chosen per file (see core.auto_chunk_size) if not given.
+    on_event is called in this process with events of all the workers, and with
+    a key_cache event (see KeyCache.stats) when the batch is done.
+    compression and compression_level are passed on to encrypt_files.
+    progress (sizes of files in the given order) is updated with byte-weighted
+    progress of every file and the number of key derivations."""
+    if not files:
+        return
+
+    if key_cache is None:
+        with KeyCache() as session_cache:
+            yield from process_files_parallel(
+                files,
+                password,
+                mode,
+                workers,
+                memory_budget,
+                batch_key,
+                session_cache,
+                chunk_size,
+                on_event,
+                compression,
+                compression_level,
+                progress,
+            )
+            if on_event and mode != "_enc":
+                on_event({"event": "key_cache", **session_cache.stats()})
+        return
+
+    options: dict[str, Any] = {}
+    if mode == "_enc":
+        options = {"compression": compression, "compression_level": compression_level}
+
+    derived_key: tuple[bytes, bytes] | None = None
+    if mode == "_enc" and batch_key:
+        yield 0, next(iter(files)).path.name
+        derived_key = Key.key_derive(password)
+
+    workers = min(worker_count(workers, memory_budget), len(files))
+    # Salt and scrypt parameters of every file, which together determine its key
+    key_params: dict[File, tuple] = {}
+    if mode != "_enc" and (workers > 1 or progress):
+        key_params = {file_in: safe_read_key_params(file_in.path) for file_in in files}
+        # Headers may ask for more memory than the parameters Vaultea writes
+        scrypt_memory = max(
+            (128 * r * n for _, n, r, _ in filter(None, key_params.values())),
+            default=SCRYPT_MEMORY,
+        )
+        workers = min(workers, worker_count(workers, memory_budget, scrypt_memory))
+    if progress:
+        if mode == "_enc":
+            progress.derivations = 1 if batch_key else len(files)
+        else:
+            progress.derivations = len(set(key_params.values()) - {()})
+
+    if workers < 2:
+        keys = derived_key if mode == "_enc" else key_cache
+        results = PROCESSORS[mode](
+            files, password, keys, chunk_size=chunk_size, on_event=on_event, **options
+        )
+        if not progress:
+            yield from results
+            return
+        try:
+            for result in results:
+                if type(result[0]) in (int, float, complex):
+                    progress.advance(result[0], result[1])
+                yield result
+            progress.advance(len(files))
+        finally:
+            results.close()  # Deletes partial .tmp output if cancelled
+        return
+
+    # Share the CPUs between workers for multi-threaded processing of large files
+    threads = max(1, (os.cpu_count() or 1) // workers)
+
+    shared_params = {
+        params
+        for params, count in Counter(key_params.values()).items()
+        if params and count > 1
+    }
+
+    results = mp.Queue()
+    cancel = mp.Event()
+    executor = ProcessPoolExecutor(
+        max_workers=workers, initializer=init_worker, initargs=(results, cancel)
+    )
+    futures: dict[Future, File] = {}
+    # Largest files first, so the small ones fill the gaps at the end of the batch
+    ordered = sorted(files.items(), key=lambda item: item[0].size, reverse=True)
+    positions = {file_in: position for position, file_in in enumerate(files)}
+    try:
+        for index, (file_in, file_out) in enumerate(ordered):
+            keys: Any = derived_key
+            if mode != "_enc":
+                keys = None
+                if (params := key_params[file_in]) in shared_params:
+                    yield 0, file_in.path.name
+                    # Hand the worker only the key it needs
+                    salt, n, r, p = params
+                    keys = KeyCache(max_size=1)
+                    key = key_cache.derive(password, salt, n, r, p)
+                    keys.put(password, salt, key, n, r, p)
+            future = executor.submit(
+                process_file,
+                mode,
+                index,
+                file_in,
+                file_out,
+                password,
+                keys,
+                threads,
+                chunk_size,
+                on_event is not None,
+                options,
+            )
+            futures[future] = file_in
+
+        file_progress: dict[int, float] = {}
+        finished: set[int] = set()
+        while len(finished) < len(files):
+            try:
+                index, result = results.get(timeout=0.1)
+            except queue.Empty:
+                # Worker process died without reporting back
+                for future, file_in in futures.items():
+                    if future.done() and future.exception():
+                        yield future.exception(), file_in.path.name
+                        return
+                continue
+
+            if result is None:
+                finished.add(index)
+                file_progress[index] = 1
+                if progress:
+                    progress.finish(positions[ordered[index][0]])
+            elif isinstance(result, dict):
+                if on_event:
+                    on_event(result)
+            elif type(result[0]) in (int, float, complex):
+                file_progress[index] = result[0]
+                if progress:
+                    progress.update(positions[ordered[index][0]], *result)
+                yield sum(file_progress.values()), result[1]
+            else:
+                yield result
+    finally:
+        cancel.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        # Keep draining so workers never block on a full queue while exiting
+        while not all(future.done() for future in futures):
+            try:
+                results.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        executor.shutdown(wait=True)
+
+
+def safe_read_key_params(path: Path) -> tuple:
+    """Same as core.read_key_params, but returns an empty tuple for files that aren't
+    encrypted (see core.sniff_file), which are reported by the processor later."""
+    if not sniff_file(path):
+        return ()
+    try:
+        return read_key_params(path)
+    except (OSError, ValueError):
+        return ()
@@ -0,0 +1,157 @@
+import math
+import threading
+import time
+from typing import Sequence
+
+# Progress of a batch of files, weighted by bytes, with throughput and time left.
+#
+# Every file weighs as much as its size, so a batch of a large file and many small
+# ones doesn't jump to 99% after the small ones. Key derivations weigh KDF_BYTES
+# each. Processors update the progress as often as they like (see
+# parallel.process_files_parallel), frontends poll() it, which returns a report
+# at most once per interval.
+
+# Roughly the bytes processed in the time of a key derivation (scrypt with 1 GiB)
+KDF_BYTES = 512 * 1024**2
+UPDATE_INTERVAL = 0.1  # Seconds between reports
+SMOOTHING = 3.0  # Seconds, time constant of the averaged throughput
+
+
+class Progress:
+    """Byte-weighted progress of files with the given sizes, updated by file index.
+    Thread-safe, so processing can update it while a frontend polls it.
+    derivations is the number of key derivations the batch needs, one per file
+    unless set otherwise."""
+
+    def __init__(
+        self,
+        sizes: Sequence[int],
+        interval: float = UPDATE_INTERVAL,
+        derivations: int | None = None,
+    ) -> None:
+        self.sizes = list(sizes)
+        self.total_bytes = sum(self.sizes)
+        self.derivations = len(self.sizes) if derivations is None else derivations
+        self.interval = interval
+        self.fractions = [0.0] * len(self.sizes)
+        self.done_bytes = 0.0
+        self.started: set[int] = set()  # Files past their key derivation
+        self.finished = 0  # Files before this index are done, see advance
+        self.name = ""
+        self.start = time.monotonic()
+        self._lock = threading.Lock()
+        # State of the last report, for the averaged rates
+        self._last_time: float | None = None
+        self._last_units = 0.0
+        self._last_bytes = 0.0
+        self.rate: float | None = None  # Weighted bytes per second, for time left
+        self.byte_rate: float | None = None  # File bytes per second
+
+    def update(self, index: int, fraction: float, name: str = "") -> None:
+        """Set progress of a single file. Progress never goes back."""
+        with self._lock:
+            self._update(index, fraction, name)
+
+    def _update(self, index: int, fraction: float, name: str) -> None:
+        fraction = min(max(fraction, 0.0), 1.0)
+        if fraction > self.fractions[index]:
+            self.done_bytes += (fraction - self.fractions[index]) * self.sizes[index]
+            self.fractions[index] = fraction
+            self.started.add(index)
+        if name:
+            self.name = name
+
+    def finish(self, index: int) -> None:
+        self.update(index, 1.0)
+
+    def advance(self, value: float, name: str = "") -> None:
+        """Update from the progress yielded by a sequential processor (see
+        core.encrypt_files), which is the number of files done plus the fraction
+        of the current one."""
+        index = min(int(value), len(self.sizes))
+        with self._lock:
+            while self.finished < index:
+                self._update(self.finished, 1.0, "")
+                self.finished += 1
+            if index < len(self.sizes):
+                self._update(index, value - index, name)
+
+    def units(self) -> tuple[float, float]:
+        """Weighted bytes done and in total, key derivations included."""
+        derived = min(self.derivations, len(self.started))
+        return (
+            self.done_bytes + derived * KDF_BYTES,
+            self.total_bytes + self.derivations * KDF_BYTES,
+        )
+
+    def poll(self) -> dict | None:
+        """Report, unless the last one was less than interval seconds ago."""
+        now = time.monotonic()
+        if self._last_time is not None and now - self._last_time < self.interval:
+            return None
+        return self.report(now)
+
+    def report(self, now: float | None = None) -> dict:
+        """progress (0 to 1), bytes done and in total, smoothed rate in bytes per
+        second and eta in seconds (None until known), and the current file name."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            done, total = self.units()
+            done_bytes, name = self.done_bytes, self.name
+
+        if self._last_time is not None and now > self._last_time:
+            elapsed = now - self._last_time
+            weight = 1 - math.exp(-elapsed / SMOOTHING)
+            rate = (done - self._last_units) / elapsed
+            byte_rate = (done_bytes - self._last_bytes) / elapsed
+            self.rate = (
+                rate if self.rate is None else self.rate + weight * (rate - self.rate)
+            )
+            # Throughput of the files is unknown until they are being processed
+            if self.byte_rate is not None:
+                self.byte_rate += weight * (byte_rate - self.byte_rate)
+            elif done_bytes > self._last_bytes:
+                self.byte_rate = byte_rate
+        self._last_time, self._last_units, self._last_bytes = now, done, done_bytes
+
+        eta = None
+        if self.rate:
+            eta = round((total - done) / self.rate, 1)
+        return {
+            "progress": round(done / total, 4) if total else 1.0,
+            "bytes": int(done_bytes),
+            "total": self.total_bytes,
+            "rate": None if self.byte_rate is None else round(self.byte_rate),
+            "eta": eta,
+            "elapsed": round(now - self.start, 1),
+            "file": name,
+        }
+
+
+def describe(report: dict) -> str:
+    """Report as text like '42%, 120.5 MiB/s, 1 min 20 s left'."""
+    parts = [f"{math.floor(report['progress'] * 100)}%"]
+    if report["rate"] is not None:
+        parts.append(f"{format_bytes(report['rate'])}/s")
+    if report["eta"] is not None:
+        parts.append(f"{format_seconds(report['eta'])} left")
+    return ", ".join(parts)
+
+
+def format_bytes(num: float) -> str:
+    for unit in ("bytes", "KiB", "MiB", "GiB"):
+        if num < 1024 or unit == "GiB":
+            break
+        num /= 1024
+    return f"{round(num, 1)} {unit}"
+
+
+def format_seconds(seconds: float) -> str:
+    seconds = math.ceil(seconds)
+    if seconds < 60:
+        return f"{seconds} s"
+    minutes, seconds = divmod(seconds, 60)
+    if minutes < 60:
+        return f"{minutes} min {seconds} s"
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours} h {minutes} min"
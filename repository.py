@@ -0,0 +1,367 @@
+import hashlib
+import hmac
+import json
+import os
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Iterator
+
+from Crypto.Cipher import ChaCha20_Poly1305
+
+from container import TAG_SIZE, read_file_header
+from core import Key, KeyCache, decrypt_data_key
+
+# Content-addressed store for incremental and deduplicated encryption of folders
+# and files.
+#
+# A repository is a folder holding:
+#   config      Header of a segmented container (see container.py) without any
+#               segments. It holds the salt, scrypt parameters and the encrypted
+#               repository key, which is unlocked with the password as usual.
+#   objects/    Encrypted chunks of member contents, named by their id.
+#   snapshots/  Encrypted manifests, one per snapshot name. A snapshot is named after
+#               the backed up folder or file unless given another name, and it
+#               records the resolved path it was taken of.
+#
+# Files are split into chunks by content (see Chunker). Object ids are HMAC-SHA256
+# of the chunk plaintext under a key derived from the repository key, so equal
+# chunks of any files are encrypted and stored only once, without revealing which
+# chunks are equal to anyone who doesn't know the password. Objects and manifests are stored
+# as nonce + ChaCha20-Poly1305 ciphertext + tag, with their name as associated data.
+
+# Chunk sizes. Candidates occur once per 2**ANCHOR_LENGTH bytes of random data and
+# one in CUT_RATIO of them is a boundary, so chunks average about 512 KiB.
+MIN_CHUNK_SIZE = 256 * 1024  # 256 KiB
+MAX_CHUNK_SIZE = 8 * 1024 * 1024  # 8 MiB
+ANCHOR_LENGTH = 6
+CUT_RATIO = 4096
+WINDOW_SIZE = 32  # Bytes before a candidate that decide whether it is a boundary
+ANCHOR_ATTEMPTS = 64  # Anchors drawn from the key until one isn't periodic
+SEARCH_STEP = 1024 * 1024  # Bytes searched for candidates at once
+READ_SIZE = 4 * 1024 * 1024  # 4 MiB
+NONCE_SIZE = 12
+MANIFEST_VERSION = 1
+
+
+class SnapshotNotFoundError(ValueError):
+    pass
+
+
+def derive_subkey(key: bytes, purpose: bytes) -> bytes:
+    return hmac.new(key, b"vaultea " + purpose, hashlib.sha256).digest()
+
+
+class Repository:
+    """Repository opened with the password. Use create() or open() to get one.
+    stats counts what the latest operations did (members, unchanged, objects_new,
+    objects_reused, bytes_read, bytes_stored)."""
+
+    def __init__(self, path: Path, key: bytes) -> None:
+        self.path = path
+        self.cipher_key = derive_subkey(key, b"objects")
+        self.id_key = derive_subkey(key, b"ids")
+        self.chunker = Chunker(key)
+        self.stats: Counter[str] = Counter()
+
+    @classmethod
+    def create(cls, path: Path, password: str) -> "Repository":
+        if (path / "config").exists():
+            raise FileExistsError(f"Repository {path} already exists")
+        key = Key(password)
+        (path / "objects").mkdir(parents=True, exist_ok=True)
+        (path / "snapshots").mkdir(exist_ok=True)
+        (path / "config").write_bytes(key.header().pack())
+        return cls(path, key.data_key)
+
+    @classmethod
+    def open(
+        cls, path: Path, password: str, key_cache: KeyCache | None = None
+    ) -> "Repository":
+        """Raises KeyError on incorrect password."""
+        try:
+            header = read_file_header(path / "config")
+        except FileNotFoundError:
+            header = None
+        if not header:
+            raise ValueError(f"{path} is not a repository")
+        return cls(path, decrypt_data_key(header, password, key_cache))
+
+    def object_id(self, data: bytes | memoryview) -> str:
+        return hmac.new(self.id_key, data, hashlib.sha256).hexdigest()
+
+    def object_path(self, object_id: str) -> Path:
+        return self.path / "objects" / object_id[:2] / object_id
+
+    def put(self, data: bytes | memoryview) -> str:
+        """Store chunk unless it is already stored. Returns its id."""
+        object_id = self.object_id(data)
+        path = self.object_path(object_id)
+        if path.exists():
+            self.stats["objects_reused"] += 1
+            return object_id
+        path.parent.mkdir(exist_ok=True)
+        self.write_blob(path, data, object_id.encode())
+        self.stats["objects_new"] += 1
+        self.stats["bytes_stored"] += len(data)
+        return object_id
+
+    def get(self, object_id: str) -> bytes:
+        """Read and verify chunk. Raises ValueError if it is corrupt."""
+        return self.read_blob(self.object_path(object_id), object_id.encode())
+
+    def write_blob(self, path: Path, data: bytes | memoryview, aad: bytes) -> None:
+        """Encrypt data into path. A partially written blob never replaces
+        an existing one."""
+        cipher = ChaCha20_Poly1305.new(key=self.cipher_key)
+        cipher.update(aad)
+        ciphertext, tag = cipher.encrypt_and_digest(data)
+        path_tmp = path.with_name(f"{path.name}.tmp")
+        with open(path_tmp, "wb") as file:
+            file.write(cipher.nonce)
+            file.write(ciphertext)
+            file.write(tag)
+        path_tmp.replace(path)
+
+    def read_blob(self, path: Path, aad: bytes) -> bytes:
+        blob = path.read_bytes()
+        if len(blob) < NONCE_SIZE + TAG_SIZE:
+            raise ValueError(f"Corrupt object {path.name}")
+        cipher = ChaCha20_Poly1305.new(key=self.cipher_key, nonce=blob[:NONCE_SIZE])
+        cipher.update(aad)
+        return cipher.decrypt_and_verify(blob[NONCE_SIZE:-TAG_SIZE], blob[-TAG_SIZE:])
+
+    def snapshot_path(self, name: str) -> Path:
+        """Snapshot files are named by a MAC of the snapshot name, which hides it."""
+        digest = hmac.new(self.id_key, b"snapshot " + name.encode(), hashlib.sha256)
+        return self.path / "snapshots" / digest.hexdigest()
+
+    def load_manifest(self, name: str) -> dict:
+        """Manifest of the latest snapshot named name, empty if there is none."""
+        path = self.snapshot_path(name)
+        if not path.exists():
+            return {"version": MANIFEST_VERSION, "name": name, "members": {}}
+        return json.loads(self.read_blob(path, path.name.encode()))
+
+    def save_manifest(self, manifest: dict) -> None:
+        path = self.snapshot_path(manifest["name"])
+        self.write_blob(path, json.dumps(manifest).encode(), path.name.encode())
+
+    def manifests(self) -> Iterator[dict]:
+        for path in (self.path / "snapshots").iterdir():
+            if not path.name.endswith(".tmp"):
+                yield json.loads(self.read_blob(path, path.name.encode()))
+
+
+class Chunker:
+    """Content-defined chunking: chunk boundaries follow the content, so an insertion
+    or a removal only changes the chunks around it and the rest are deduplicated.
+
+    Candidates are the ends of anchors, runs of ANCHOR_LENGTH bytes whose classes form
+    a certain pattern, with every byte value in one of two classes. A candidate is a
+    boundary if a keyed hash of the WINDOW_SIZE bytes before it is below a threshold.
+    Classes, the pattern and the hash key come from the repository key, so boundaries
+    don't reveal anything about the content. This does the job of a rolling hash, but
+    candidates are found by bytes.translate and bytes.find, as hashing every byte in
+    a Python loop would be many times slower than the cipher."""
+
+    def __init__(self, key: bytes) -> None:
+        secret = derive_subkey(key, b"chunker")
+        stream = hashlib.shake_256(secret).digest(256 + ANCHOR_ATTEMPTS * ANCHOR_LENGTH)
+        self.table = bytes(value & 1 for value in stream[:256])
+        # Periodic anchors (like 000000 or 010101) would match at every position of
+        # runs of a repeated byte or pattern, e.g. the zeros in disk images, and every
+        # candidate would be hashed. The first anchor of the stream that isn't is used.
+        for offset in range(256, len(stream), ANCHOR_LENGTH):
+            anchor = bytes(
+                value & 1 for value in stream[offset : offset + ANCHOR_LENGTH]
+            )
+            if not is_periodic(anchor):
+                break
+        self.anchor = anchor
+        self.hash_key = derive_subkey(secret, b"window")
+        self.threshold = 2**64 // CUT_RATIO
+
+    def is_boundary(self, window: bytes | bytearray) -> bool:
+        digest = hashlib.blake2b(window, digest_size=8, key=self.hash_key).digest()
+        return int.from_bytes(digest, "little") < self.threshold
+
+    def cut(self, data: bytearray) -> int:
+        """Length of the first chunk of data, which holds MAX_CHUNK_SIZE bytes
+        unless it is the end of the file."""
+        end = min(len(data), MAX_CHUNK_SIZE)
+        position = MIN_CHUNK_SIZE - ANCHOR_LENGTH
+        while position < end - ANCHOR_LENGTH:
+            classes = data[position : min(position + SEARCH_STEP, end)].translate(
+                self.table
+            )
+            index = classes.find(self.anchor)
+            rejected = b""
+            while index >= 0:
+                boundary = position + index + ANCHOR_LENGTH
+                window = data[boundary - WINDOW_SIZE : boundary]
+                # Repeated patterns repeat their windows, which are rejected again
+                if window != rejected:
+                    if self.is_boundary(window):
+                        return boundary
+                    rejected = window
+                index = classes.find(self.anchor, index + 1)
+            # Searches overlap, so anchors crossing their border are found
+            position += SEARCH_STEP - ANCHOR_LENGTH + 1
+        return end
+
+    def chunks(self, path: Path) -> Iterator[bytes]:
+        buffer = bytearray()
+        end_of_file = False
+        with open(path, "rb") as file:
+            while True:
+                while not end_of_file and len(buffer) < MAX_CHUNK_SIZE:
+                    data = file.read(READ_SIZE)
+                    end_of_file = not data
+                    buffer += data
+                if not buffer:
+                    return
+                length = self.cut(buffer)
+                yield bytes(buffer[:length])
+                del buffer[:length]
+
+
+def is_periodic(anchor: bytes) -> bool:
+    """Whether anchor repeats itself with a period shorter than its length, so that
+    its occurrences can overlap."""
+    return any(anchor[shift:] == anchor[:-shift] for shift in range(1, len(anchor)))
+
+
+def store_file(repo: Repository, path: Path) -> Iterator[tuple[str, int]]:
+    """Split file into chunks and store them. Yields id and size of every chunk."""
+    for chunk in repo.chunker.chunks(path):
+        repo.stats["bytes_read"] += len(chunk)
+        yield repo.put(chunk), len(chunk)
+
+
+def backup(path: Path, repo: Repository, name: str | None = None) -> Iterator[int]:
+    """Take a new snapshot of a folder or a file into the repository. Files whose size
+    and modification time match the previous snapshot are not read at all, changed
+    and new ones only add the chunks that aren't stored yet, in any snapshot.
+    The snapshot is named name, or after the folder or file if not given.
+    Yields number of file bytes processed (unchanged files included).
+    Raises ValueError if a snapshot of that name was taken of another path."""
+    name = name or path.name
+    source = str(path.resolve())
+    manifest = repo.load_manifest(name)
+    if repo.snapshot_path(name).exists() and manifest.get("source") != source:
+        raise ValueError(
+            f"Snapshot {name} was taken of {manifest.get('source', 'another path')}"
+            f", not {source}. Choose another snapshot name."
+        )
+    previous = manifest["members"]
+    members: dict[str, dict] = {}
+    if path.is_dir():
+        repo_path = repo.path.resolve()
+        paths = [
+            (member, member.relative_to(path).as_posix())
+            for member in sorted(path.rglob("*"))
+            if member.resolve() != repo_path
+            and repo_path not in member.resolve().parents
+        ]
+    else:
+        paths = [(path, path.name)]
+
+    for member_path, member_name in paths:
+        stat = member_path.stat()
+        if member_path.is_dir():
+            members[f"{member_name}/"] = {"mtime_ns": stat.st_mtime_ns}
+            continue
+
+        repo.stats["members"] += 1
+        member = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        old = previous.get(member_name)
+        if old and all(old[field] == member[field] for field in member):
+            members[member_name] = old
+            repo.stats["unchanged"] += 1
+            yield stat.st_size
+            continue
+
+        member["chunks"] = []
+        for object_id, length in store_file(repo, member_path):
+            member["chunks"].append(object_id)
+            yield length
+        members[member_name] = member
+
+    repo.save_manifest(
+        {
+            "version": MANIFEST_VERSION,
+            "name": name,
+            "source": source,
+            "folder": path.is_dir(),
+            "created": time.time(),
+            "members": members,
+        }
+    )
+
+
+def restore(
+    repo: Repository,
+    name: str,
+    output_dir: Path,
+    members: list[str] | None = None,
+    force: bool = False,
+) -> Iterator[int]:
+    """Restore latest snapshot named name of a folder (or some of its members) or a
+    file into output_dir. Folders are restored into a subfolder named name.
+    Every file is written to a .tmp file first, which replaces the output once all
+    of its chunks are verified. Yields number of file bytes written.
+    Raises SnapshotNotFoundError if there is no such snapshot, FileExistsError if
+    an output file exists, unless force is set."""
+    if not repo.snapshot_path(name).exists():
+        raise SnapshotNotFoundError(f"There is no snapshot named {name}")
+    manifest = repo.load_manifest(name)
+    root = (output_dir / name if manifest["folder"] else output_dir).resolve()
+    selected: list[tuple[Path, str, dict]] = []
+    for member_name, member in manifest["members"].items():
+        if members is not None and member_name not in members:
+            continue
+        path = (root / member_name).resolve()
+        if root not in path.parents:
+            raise ValueError(f"Unsafe member path {member_name}")
+        if not force and not member_name.endswith("/") and path.exists():
+            raise FileExistsError(f"{path} exists")
+        selected.append((path, member_name, member))
+
+    root.mkdir(parents=True, exist_ok=True)
+    for path, member_name, member in selected:
+        if member_name.endswith("/"):
+            path.mkdir(parents=True, exist_ok=True)
+            continue
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path_tmp = path.with_name(f"{path.name}.tmp")
+        try:
+            with open(path_tmp, "wb") as file:
+                for object_id in member["chunks"]:
+                    chunk = repo.get(object_id)
+                    file.write(chunk)
+                    yield len(chunk)
+            os.utime(path_tmp, ns=(member["mtime_ns"], member["mtime_ns"]))
+            path_tmp.replace(path)
+        except BaseException:  # Corrupt chunk or cancelled
+            path_tmp.unlink(missing_ok=True)
+            raise
+
+
+def prune(repo: Repository) -> int:
+    """Delete objects no snapshot refers to. Returns number of deleted objects."""
+    used = {
+        object_id
+        for manifest in repo.manifests()
+        for member in manifest["members"].values()
+        for object_id in member.get("chunks", [])
+    }
+    deleted = 0
+    for path in (repo.path / "objects").glob("*/*"):
+        if path.name not in used:
+            path.unlink()
+            deleted += 1
+            if not any(path.parent.iterdir()):
+                path.parent.rmdir()
+    return deleted
@@ -0,0 +1,36 @@
+import json
+from pathlib import Path
+
+from cli import report
+from helpers import File
+from progress import Progress
+
+
+def results(capsys) -> dict[str, dict]:
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    return {line["file"]: line for line in lines if line["event"] == "result"}
+
+
+def test_report_matches_errors_by_path(capsys):
+    files = [File(Path("a/x.txt"), 1), File(Path("b/x.txt"), 1)]
+    outcomes = {
+        "a/x.txt": {"status": "error", "error": "OSError()"},
+        "b/x.txt": {"status": "ok"},
+    }
+    failures = report(files, iter([(OSError(), "x.txt")]), Progress([1, 1]), outcomes)
+
+    assert failures == 1
+    reported = results(capsys)
+    assert reported["a/x.txt"]["status"] == "failed"
+    assert reported["b/x.txt"]["status"] == "ok"
+
+
+def test_report_files_without_outcome_failed(capsys):
+    files = [File(Path("a/x.txt"), 1), File(Path("y.txt"), 1)]
+    crash = (RuntimeError("worker died"), "x.txt")
+    failures = report(files, iter([crash]), Progress([1, 1]), {})
+
+    assert failures == 2
+    reported = results(capsys)
+    assert "worker died" in reported["a/x.txt"]["error"]
+    assert reported["y.txt"]["error"] == "not processed"
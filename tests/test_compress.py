@@ -0,0 +1,79 @@
+import io
+import os
+
+import pytest
+
+from compress import (
+    DECOMPRESS_SIZE,
+    DecompressingWriter,
+    available_algorithms,
+    compressor,
+)
+from container import COMPRESSION_ZLIB, COMPRESSION_ZSTD
+from core import KeyCache, decrypt_files, encrypt_files
+from helpers import File
+
+PASSWORD = "password"
+SALT = os.urandom(16)
+DERIVED_KEY = os.urandom(32)
+ALGORITHMS = {"zlib": COMPRESSION_ZLIB, "zstd": COMPRESSION_ZSTD}
+
+
+class Sink(io.BytesIO):
+    """Records the size of the largest write."""
+
+    largest = 0
+
+    def write(self, data) -> int:
+        self.largest = max(self.largest, len(data))
+        return super().write(data)
+
+
+def compress(algorithm: int, data: bytes) -> bytes:
+    stream = compressor(algorithm)
+    return stream.compress(data) + stream.flush()
+
+
+@pytest.mark.parametrize("name", available_algorithms())
+def test_zeros_are_written_in_bounded_pieces(name):
+    data = bytes(64 * DECOMPRESS_SIZE)
+    sink = Sink()
+    writer = DecompressingWriter(sink, ALGORITHMS[name])
+    writer.write(compress(ALGORITHMS[name], data))  # A single small write
+    writer.close()
+    assert sink.getvalue() == data
+    assert sink.largest <= 3 * DECOMPRESS_SIZE
+
+
+@pytest.mark.parametrize("name", available_algorithms())
+def test_truncated_stream(name):
+    compressed = compress(ALGORITHMS[name], os.urandom(100_000))
+    writer = DecompressingWriter(Sink(), ALGORITHMS[name])
+    writer.write(compressed[:-10])
+    with pytest.raises(ValueError):
+        writer.close()
+
+
+@pytest.mark.parametrize("name", available_algorithms())
+def test_compressed_round_trip(tmp_path, name):
+    data = bytes(3 * DECOMPRESS_SIZE) + os.urandom(1000)
+    src = tmp_path / "file.bin"
+    src.write_bytes(data)
+    dst = tmp_path / "file.bin.teax"
+    out = tmp_path / "file.out"
+    for _ in encrypt_files(
+        {File(src, len(data)): dst},
+        PASSWORD,
+        (DERIVED_KEY, SALT),
+        threads=1,
+        compression=name,
+    ):
+        pass
+    assert dst.stat().st_size < len(data) // 10
+
+    with KeyCache() as cache:
+        cache.put(PASSWORD, SALT, DERIVED_KEY)
+        files = {File(dst, dst.stat().st_size): out}
+        results = list(decrypt_files(files, PASSWORD, cache, threads=1))
+    assert not any(result[0] is False for result in results)
+    assert out.read_bytes() == data
@@ -0,0 +1,223 @@
+import dataclasses
+import os
+from pathlib import Path
+
+import pytest
+from Crypto.Cipher import ChaCha20_Poly1305
+
+from container import (
+    HEADER_SIZE,
+    MIN_SEGMENT_SIZE,
+    TAG_SIZE,
+    Header,
+    decrypt_mapped,
+    encrypt_stream,
+    read_file_header,
+)
+from core import Key, KeyCache, decrypt_files, encrypt_files, verify_files
+from helpers import File
+
+# Keys are put into the cache beforehand, so no test pays for scrypt.
+PASSWORD = "password"
+SALT = os.urandom(16)
+DERIVED_KEY = os.urandom(32)
+SEGMENT = MIN_SEGMENT_SIZE
+BLOCK = SEGMENT + TAG_SIZE
+
+
+@pytest.fixture
+def key_cache():
+    with KeyCache() as cache:
+        cache.put(PASSWORD, SALT, DERIVED_KEY)
+        yield cache
+
+
+def decrypt(path: Path, key_cache: KeyCache) -> list:
+    files = {File(path, path.stat().st_size): path.with_suffix(".out")}
+    return list(decrypt_files(files, PASSWORD, key_cache, threads=1))
+
+
+def verify(path: Path, key_cache: KeyCache) -> list[str]:
+    statuses = []
+    files = [File(path, path.stat().st_size)]
+    for _ in verify_files(
+        files,
+        PASSWORD,
+        key_cache,
+        threads=1,
+        on_event=lambda event: statuses.append(event.get("status")),
+    ):
+        pass
+    return [status for status in statuses if status]
+
+
+def failed(results: list) -> bool:
+    return any(result[0] is False for result in results)
+
+
+def write_v2(path: Path, data: bytes) -> Path:
+    """Encrypt data into a container of small segments, so a few KiB span several."""
+    key = Key(PASSWORD, (DERIVED_KEY, SALT))
+    header = dataclasses.replace(key.header(), segment_size=SEGMENT)
+    src = path.with_suffix(".plain")
+    src.write_bytes(data)
+    dst = path.with_suffix(".teax")
+    for _ in encrypt_stream(src, dst, key.data_key, header):
+        pass
+    src.unlink()
+    return dst
+
+
+def write_v1(path: Path, data: bytes) -> Path:
+    """Encrypt data into the original single stream format."""
+    data_key = os.urandom(32)
+    key_cipher = ChaCha20_Poly1305.new(key=DERIVED_KEY)
+    key_encrypted, key_tag = key_cipher.encrypt_and_digest(data_key)
+    cipher = ChaCha20_Poly1305.new(key=data_key)
+    ciphertext, tag = cipher.encrypt_and_digest(data)
+    dst = path.with_suffix(".teax")
+    dst.write_bytes(
+        SALT + key_cipher.nonce + key_tag + key_encrypted + cipher.nonce + tag
+    )
+    with open(dst, "ab") as file:
+        file.write(ciphertext)
+    return dst
+
+
+@pytest.mark.parametrize("size", [0, 1, 5 * 1024 * 1024 + 3])
+def test_v2_round_trip(tmp_path, key_cache, size):
+    data = os.urandom(size)
+    src = tmp_path / "file.bin"
+    src.write_bytes(data)
+    dst = tmp_path / "file.bin.teax"
+    results = list(
+        encrypt_files(
+            {File(src, size): dst}, PASSWORD, (DERIVED_KEY, SALT), threads=2
+        )
+    )
+    assert not failed(results)
+    assert dst.read_bytes().startswith(b"TEAX")
+
+    assert not failed(decrypt(dst, key_cache))
+    assert dst.with_suffix(".out").read_bytes() == data
+    assert verify(dst, key_cache) == ["ok"]
+
+
+def test_chunk_size_is_honoured(tmp_path, key_cache):
+    size = 5 * 1024 * 1024
+    src = tmp_path / "file.bin"
+    src.write_bytes(os.urandom(size))
+    dst = tmp_path / "file.bin.teax"
+    phases: dict = {}
+    for _ in encrypt_files(
+        {File(src, size): dst},
+        PASSWORD,
+        (DERIVED_KEY, SALT),
+        threads=1,
+        chunk_size=1024 * 1024,
+        on_event=lambda event: phases.update(event.get("phases", {})),
+    ):
+        pass
+    assert "read" in phases  # Memory mapped engines don't read
+
+
+def test_v2_small_segments_round_trip(tmp_path, key_cache):
+    data = os.urandom(5 * SEGMENT - 120)
+    path = write_v2(tmp_path / "file", data)
+    assert not failed(decrypt(path, key_cache))
+    assert path.with_suffix(".out").read_bytes() == data
+
+
+@pytest.mark.parametrize("size", [0, 1000, 3 * 1024 * 1024])
+def test_v1_round_trip(tmp_path, key_cache, size):
+    data = os.urandom(size)
+    path = write_v1(tmp_path / "file", data)
+    assert not failed(decrypt(path, key_cache))
+    assert path.with_suffix(".out").read_bytes() == data
+    assert verify(path, key_cache) == ["ok"]
+
+
+def test_v1_tampered(tmp_path, key_cache):
+    path = write_v1(tmp_path / "file", os.urandom(5000))
+    data = bytearray(path.read_bytes())
+    data[-1] ^= 1
+    path.write_bytes(data)
+    assert failed(decrypt(path, key_cache))
+    assert verify(path, key_cache) == ["corrupt"]
+
+
+def drop_last_segment(data: bytearray) -> bytes:
+    return bytes(data[: HEADER_SIZE + 4 * BLOCK])
+
+
+def swap_segments(data: bytearray) -> bytes:
+    first = slice(HEADER_SIZE + BLOCK, HEADER_SIZE + 2 * BLOCK)
+    second = slice(HEADER_SIZE + 2 * BLOCK, HEADER_SIZE + 3 * BLOCK)
+    data[first], data[second] = data[second], data[first]
+    return bytes(data)
+
+
+def truncate(data: bytearray) -> bytes:
+    return bytes(data[:-7])
+
+
+def flip_header_bit(data: bytearray) -> bytes:
+    data[HEADER_SIZE - 1] ^= 0x10  # Nonce prefix, authenticated by every segment
+    return bytes(data)
+
+
+def flip_ciphertext_bit(data: bytearray) -> bytes:
+    data[HEADER_SIZE + 2 * BLOCK + 100] ^= 1
+    return bytes(data)
+
+
+@pytest.mark.parametrize(
+    "tamper",
+    [drop_last_segment, swap_segments, truncate, flip_header_bit, flip_ciphertext_bit],
+)
+def test_v2_tampered(tmp_path, key_cache, tamper):
+    path = write_v2(tmp_path / "file", os.urandom(5 * SEGMENT - 120))
+    path.write_bytes(tamper(bytearray(path.read_bytes())))
+
+    assert failed(decrypt(path, key_cache))
+    assert not path.with_suffix(".out").exists()
+    assert not list(tmp_path.glob("*.tmp"))
+    assert verify(path, key_cache) == ["corrupt"]
+
+
+def test_mapped_writes_only_verified_segments(tmp_path):
+    data = os.urandom(10 * SEGMENT)
+    path = write_v2(tmp_path / "file", data)
+    path.write_bytes(flip_ciphertext_bit(bytearray(path.read_bytes())))
+    header = read_file_header(path)
+    data_key = ChaCha20_Poly1305.new(
+        key=DERIVED_KEY, nonce=header.key_nonce
+    ).decrypt_and_verify(header.key_encrypted, header.key_tag)
+    dst = tmp_path / "file.out"
+    with pytest.raises(ValueError):
+        for _ in decrypt_mapped(path, dst, data_key, header):
+            pass
+    # The flipped bit is at offset 100 of the third segment
+    assert data[2 * SEGMENT + 101 : 3 * SEGMENT] not in dst.read_bytes()
+
+
+@pytest.mark.parametrize(
+    "log2_n, r, accepted", [(20, 8, True), (22, 8, True), (22, 32, False)]
+)
+def test_scrypt_memory_is_capped(log2_n, r, accepted):
+    key = Key(PASSWORD, (DERIVED_KEY, SALT))
+    header = dataclasses.replace(key.header(), scrypt_log2_n=log2_n, scrypt_r=r)
+    if accepted:
+        assert Header.unpack(header.pack()) == header
+    else:
+        with pytest.raises(ValueError):
+            Header.unpack(header.pack())
+
+
+def test_wrong_password(tmp_path, key_cache):
+    path = write_v2(tmp_path / "file", b"data")
+    key_cache.put("other", SALT, os.urandom(32))
+    files = {File(path, path.stat().st_size): path.with_suffix(".out")}
+    results = list(decrypt_files(files, "other", key_cache, threads=1))
+    assert failed(results)
+    assert not path.with_suffix(".out").exists()
@@ -0,0 +1,101 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from repository import (
+    MAX_CHUNK_SIZE,
+    Chunker,
+    Repository,
+    SnapshotNotFoundError,
+    backup,
+    restore,
+)
+
+
+@pytest.fixture
+def repo(tmp_path):
+    path = tmp_path / "repo"
+    (path / "objects").mkdir(parents=True)
+    (path / "snapshots").mkdir()
+    return Repository(path, os.urandom(32))
+
+
+def make_folder(root: Path, content: bytes) -> Path:
+    folder = root / "proj"
+    (folder / "sub").mkdir(parents=True)
+    (folder / "sub" / "f.txt").write_bytes(content)
+    os.utime(folder / "sub" / "f.txt", ns=(10**18, 10**18))
+    return folder
+
+
+def run(iterator) -> None:
+    for _ in iterator:
+        pass
+
+
+def test_backup_and_restore(tmp_path, repo):
+    folder = make_folder(tmp_path, b"data")
+    run(backup(folder, repo))
+    run(backup(folder, repo))
+    assert repo.stats["unchanged"] == 1
+
+    run(restore(repo, "proj", tmp_path / "out"))
+    assert (tmp_path / "out" / "proj" / "sub" / "f.txt").read_bytes() == b"data"
+
+
+def test_same_name_of_another_path_is_refused(tmp_path, repo):
+    run(backup(make_folder(tmp_path / "A", b"AAAA"), repo))
+    other = make_folder(tmp_path / "B", b"BBBB")
+    with pytest.raises(ValueError):
+        run(backup(other, repo))
+
+    run(backup(other, repo, "proj-b"))
+    run(restore(repo, "proj", tmp_path / "out"))
+    run(restore(repo, "proj-b", tmp_path / "out"))
+    assert (tmp_path / "out" / "proj" / "sub" / "f.txt").read_bytes() == b"AAAA"
+    assert (tmp_path / "out" / "proj-b" / "sub" / "f.txt").read_bytes() == b"BBBB"
+
+
+def test_restore_refuses_existing_files(tmp_path, repo):
+    folder = make_folder(tmp_path, b"old")
+    run(backup(folder, repo))
+    (folder / "sub" / "f.txt").write_bytes(b"newer")
+
+    with pytest.raises(FileExistsError):
+        run(restore(repo, "proj", tmp_path))
+    assert (folder / "sub" / "f.txt").read_bytes() == b"newer"
+
+    run(restore(repo, "proj", tmp_path, force=True))
+    assert (folder / "sub" / "f.txt").read_bytes() == b"old"
+
+
+def test_restore_corrupt_chunk_leaves_no_file(tmp_path, repo):
+    run(backup(make_folder(tmp_path, b"data"), repo))
+    for path in (repo.path / "objects").glob("*/*"):
+        blob = bytearray(path.read_bytes())
+        blob[-1] ^= 1
+        path.write_bytes(blob)
+
+    with pytest.raises(ValueError):
+        run(restore(repo, "proj", tmp_path / "out"))
+    assert not [path for path in (tmp_path / "out").rglob("*") if path.is_file()]
+
+
+def test_restore_unknown_snapshot(tmp_path, repo):
+    with pytest.raises(SnapshotNotFoundError):
+        run(restore(repo, "missing", tmp_path))
+
+
+def test_chunker_anchor_is_not_periodic():
+    for _ in range(200):
+        anchor = Chunker(os.urandom(32)).anchor
+        assert not any(anchor[k:] == anchor[:-k] for k in range(1, len(anchor)))
+
+
+@pytest.mark.parametrize("pattern", [b"\0", b"\0\xff", bytes(range(7))])
+def test_chunker_repeated_data(pattern):
+    data = bytearray(pattern * (2 * MAX_CHUNK_SIZE // len(pattern)))
+    for _ in range(4):
+        length = Chunker(os.urandom(32)).cut(data)
+        assert 0 < length <= MAX_CHUNK_SIZE
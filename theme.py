@@ -1,3 +1,6 @@
+import functools
+from typing import Any
+
 import dearpygui.dearpygui as dpg
 
 import helpers
@@ -95,9 +98,16 @@ def load_fonts() -> None:
             dpg.add_font_range_hint(dpg.mvFontRangeHint_Japanese)
 
 
-def load_icons() -> None:
-    path = helpers.resource_path("resources/icons/checkmark.png")
+@functools.cache
+def read_image(name: str) -> tuple[int, int, Any]:
+    """Decoded image, kept for the next contexts of the process (file browser)."""
+    path = helpers.resource_path(f"resources/icons/{name}")
     width, height, _, data = dpg.load_image(str(path))
+    return width, height, data
+
+
+def load_icons() -> None:
+    width, height, data = read_image("checkmark.png")
     with dpg.texture_registry():
         dpg.add_static_texture(
             width=width, height=height, default_value=data, tag="checkmark"
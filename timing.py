@@ -0,0 +1,73 @@
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator
+
+# Optional instrumentation of file processing.
+#
+# Processors accept an on_event callback, which is called with a dict for every
+# event: "file_start" before a file is processed and "file_end" after it, the latter
+# with the outcome (status, and error for unexpected exceptions) and per-phase
+# timings and byte counts of the file. Phases are
+# kdf, archive, compress, read, cipher, write and rename. Batches of decrypted or
+# verified files end with a "key_cache" event holding KeyCache.stats.
+
+EventCallback = Callable[[dict], None]
+
+
+class PhaseTimer:
+    """Seconds and bytes spent in each phase of processing a single file.
+    Phases of files processed by several threads are summed over the threads,
+    so they can add up to more than the wall clock time."""
+
+    def __init__(self) -> None:
+        self.seconds: Counter[str] = Counter()
+        self.bytes: Counter[str] = Counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str, size: int = 0) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, size)
+
+    def add(self, name: str, seconds: float, size: int = 0) -> None:
+        with self._lock:
+            self.seconds[name] += seconds
+            self.bytes[name] += size
+
+    def report(self) -> dict:
+        return {
+            "phases": {name: round(s, 6) for name, s in self.seconds.items()},
+            "bytes": {name: size for name, size in self.bytes.items() if size},
+        }
+
+
+def file_event(event: str, operation: str, path: Path, size: int, **fields) -> dict:
+    return {
+        "event": event,
+        "operation": operation,
+        "file": str(path),
+        "size": size,
+        **fields,
+    }
+
+
+def timed_iter(iterator: Iterator, timer: PhaseTimer, name: str) -> Iterator:
+    """Yield from iterator, adding time spent inside it to phase name, except for
+    time that was meanwhile added to other phases of the same timer."""
+    while True:
+        before = sum(timer.seconds.values())
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            elapsed = time.perf_counter() - start
+            timer.add(name, elapsed - (sum(timer.seconds.values()) - before))
+        yield item